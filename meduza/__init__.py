@@ -1,26 +1,60 @@
+import collections
 from contextlib import contextmanager
+import Queue
+import sys
+import threading
+import time
 
 from meduza.queries import *
 from meduza.client import *
 from meduza.model import Model
+from meduza.cache import LRUCache
+from meduza.coalesce import Coalescer
+from meduza.columnar import decodeColumns
+from meduza.replicas import ReplicaConnector
+from meduza import stats
 from meduza.columns import Key, Text, Timestamp, Set
-from meduza.errors import MeduzaError, ModelError, RequestError
+from meduza.errors import MeduzaError, ModelError, RequestError, PoolExhaustedError
 
 
 __author__ = 'dvirsky'
 
 
-def customConnector(host, port, timeout=0.5):
+DEFAULT_SCAN_PAGE_SIZE = 100
+
+# puts larger than these are split into chunks, pipelined on one connection
+DEFAULT_PUT_CHUNK_SIZE = 1000
+DEFAULT_PUT_CHUNK_BYTES = 4 * 1024 * 1024
+
+
+def customConnector(host, port, timeout=0.5, poolSize=DEFAULT_MAX_SIZE, idleTimeout=DEFAULT_IDLE_TIMEOUT,
+                    waitTimeout=DEFAULT_WAIT_TIMEOUT):
+    """
+    Create a connector yielding clients that work on pooled connections to the given server.
+    Connections are taken from the process wide pool for host:port and these settings (see getPool), and returned to
+    it when the client is done.
+    :param poolSize: the maximal number of connections to the server
+    :param idleTimeout: seconds after which idle connections are closed
+    :param waitTimeout: seconds to wait for a connection if all of them are in use
+    :return: a connector context manager. Its pool is available as connector.pool, and connector.warmup(n) opens n
+    connections ahead of use
+    """
+
+    pool = getPool(host, port, timeout, maxSize=poolSize, idleTimeout=idleTimeout, waitTimeout=waitTimeout)
 
     @contextmanager
     def connector():
-        yield RedisClient(host=host, port=port,timeout=timeout)
+        with pool.connection() as transport:
+            yield RedisClient(transport=transport)
 
+    connector.pool = pool
+    connector.warmup = lambda connections: warmPool(pool, connections)
     return connector
 
 @contextmanager
 def defaultConnector():
-    yield RedisClient()
+    with getPool().connection() as transport:
+        yield RedisClient(transport=transport)
 
 
 
@@ -30,25 +64,56 @@ def ping(client):
         return res.error is None
 
 
-class Session(object):
+def warmup(connector, connections):
+    """
+    Open connections through a connector ahead of the first requests, so they don't pay the connect latency.
+    Connectors with a warmup method (see customConnector and ReplicaConnector) are delegated to it. Otherwise we check
+    out that many clients from the connector at once, pinging the server through each
+    :param connections: the number of connections to open
+    """
 
-    def __init__(self, masterConnector = defaultConnector, slaveConnector = defaultConnector):
+    if hasattr(connector, 'warmup'):
+        connector.warmup(connections)
+        return
 
-        self._master = masterConnector
-        self._slave = slaveConnector
+    contexts = []
+    try:
+        for _ in xrange(connections):
+            ctx = connector()
+            client = ctx.__enter__()
+            try:
+                if not ping(client):
+                    raise MeduzaError("Error pinging server")
+            except:
+                # exiting with the error makes the connector discard the failed connection
+                excInfo = sys.exc_info()
+                ctx.__exit__(*excInfo)
+                raise excInfo[0], excInfo[1], excInfo[2]
+            contexts.append(ctx)
+    finally:
+        while contexts:
+            contexts.pop().__exit__(None, None, None)
+
+
+class _SessionBase(object):
+    """
+    The query building and response handling shared by Session and the asyncio AsyncSession, which send the queries
+    in their own ways
+    """
 
-    def select(self, model, filters, **kwargs):
-        """
-        Select objects based on secondary indexes. The model class is used to construct object instances
-        :param model: a model class to create instances from
-        :param filters: a list of filters
-        :param kwargs: extra parameters:
-            * properties - a list of properties to get
-            * order - an ordering object (order by ? asc/desc)
-            * paging - start/offset
-            * limit - same as paging but start=0
-        :return: a list of objects generated from the model class
-        """
+    # an optional LRUCache of raw entity documents, invalidated by writes. See Session.__init__
+    _cache = None
+
+    @staticmethod
+    def _filterTuple(filters):
+
+        # Filters can be a list of filters or a single filter
+        try:
+            return tuple(filters)
+        except TypeError:
+            return (filters,)
+
+    def _selectQuery(self, model, filters, kwargs):
 
         if 'paging' in kwargs:
             paging = kwargs['paging']
@@ -57,31 +122,258 @@ class Session(object):
         else:
             paging = None
 
-        # Filters can be a list of filters or a single filter
-        try:
-            filters = tuple(filters)
-        except TypeError:
-            filters = (filters,)
+        return queries.GetQuery(model.tableName(), filters=self._filterTuple(filters),
+                                properties=kwargs.get('properties', tuple()),
+                                order=kwargs.get('order', None),
+                                paging=paging)
 
+    def _getQuery(self, model, ids, kwargs):
 
-        q = queries.GetQuery(model.tableName(), filters=filters,
-                             properties=kwargs.get('properties', tuple()),
-                             order=kwargs.get('order', None),
-                             paging=paging)
+        for id in ids:
+            if not isinstance(id, basestring):
+                raise MeduzaError("Invalid id type: %s", type(id))
 
-        with self._slave() as client:
-            res = client.do(q)
+        return queries.GetQuery(model.tableName(),
+                    properties=kwargs.get('properties', tuple()))\
+            .filter(model.__primary__, Condition.IN, *ids)\
+            .limit(len(ids))
+
+    def _loadResponse(self, model, res, kwargs):
 
         if res.error is not None:
             raise RequestError(res.error)
 
-        objs = res.load(model)
+        st = time.time()
+        if kwargs.get('columnar'):
+            objs = res.loadColumns(model, kwargs.get('properties'))
+        else:
+            model = model.projected(kwargs.get('properties'))
+            objs = res.loadLazy(model) if kwargs.get('lazy') else res.load(model)
+        stats.record(Message.GET, model.tableName(), stats.DECODE, time.time() - st)
 
         if kwargs.get('withTotal'):
             return objs, res.total
         else:
             return objs
 
+    def _tablePutGroups(self, objects):
+        """
+        Group objects for putting by their table, keeping the order of the first object of each table
+        :return: a list of object lists
+        """
+
+        groups = collections.OrderedDict()
+        for obj in objects:
+            if not isinstance(obj, Model):
+                raise ModelError("Non model object found")
+            groups.setdefault(obj.tableName(), []).append(obj)
+
+        return groups.values()
+
+    def _putQuery(self, ttl, objects, sameClass=True):
+        """
+        Build a put query for objects of one table
+        :param sameClass: if True, all the objects must be of the same model class
+        """
+
+        q = queries.PutQuery(objects[0].tableName())
+
+        cls = objects[0].__class__
+        if not isinstance(objects[0], Model):
+            raise ModelError("Non model object found")
+
+        if all(obj.__class__ is cls for obj in objects):
+            entities = cls.__batchEncoder__(objects)
+        elif sameClass:
+            raise MeduzaError("All objects in a PUT call must be of the same class")
+        else:
+            entities = [obj.__encoder__(obj) for obj in objects]
+
+        for ent in entities:
+            if ttl > 0:
+                ent.expire(ttl)
+            q.add(ent)
+
+        return q
+
+    def _putResponse(self, objects, res):
+
+        # objects without ids are new, so they can't be cached
+        if self._cache is not None:
+            table = objects[0].tableName()
+            self._cache.delete(*((table, obj.id) for obj in objects if obj.id is not None))
+
+        if res.error is not None:
+            raise RequestError("Error putting objects: %s", res.error)
+
+        for i, id in enumerate(res.ids):
+
+            objects[i].setPrimary(id)
+            objects[i].markSaved()
+
+        return res.ids
+
+    def _chunkedPutResponse(self, objects, chunks):
+        """
+        Fill in the ids of objects put in chunks, given the (number of objects, PutResponse) of each chunk
+        """
+
+        ids = []
+        err = None
+        offset = 0
+        for num, res in chunks:
+            try:
+                ids.extend(self._putResponse(objects[offset:offset + num], res))
+            except RequestError as e:
+                err = err or e
+            offset += num
+
+        if err is not None:
+            raise err
+
+        return ids
+
+    def _invalidate(self, model, filters):
+        """
+        Remove the cached objects of a model that a write selecting them with filters might have changed. If the
+        filters select by ids (primary key EQ or IN), these are the objects of the ids, otherwise all the objects of the
+        model
+        """
+        if self._cache is None:
+            return
+
+        table = model.tableName()
+        for flt in self._filterTuple(filters):
+            if getattr(flt, 'property', None) == model.__primary__ and flt.op in (Condition.EQ, Condition.IN):
+                normalize = model.__columns__[model.__primary__].decode
+                self._cache.delete(*((table, normalize(id)) for id in flt.values))
+                return
+
+        self._cache.deleteIf(lambda key: key[0] == table)
+
+    def _deleteQuery(self, model, filters):
+
+        return queries.DelQuery(model.tableName(), *self._filterTuple(filters))
+
+    def _deleteResponse(self, model, filters, res):
+
+        self._invalidate(model, filters)
+
+        if res.error is not None:
+            raise RequestError("Error deleting objects: %s", res.error)
+
+        return res.num
+
+    def _updateQuery(self, model, filters, deletions, changes):
+
+        changeList = list(deletions)
+
+        for k,v in changes.iteritems():
+            if isinstance(v, Change):
+                if k != "_":
+                    assert getattr(model, k).name == v.property, "Mismatching property key and name %s" % k
+                changeList.append(v)
+            else:
+                changeList.append(Change.set(getattr(model, k).name, v))
+
+
+        return queries.UpdateQuery(model.tableName(), self._filterTuple(filters), *changeList)
+
+    @staticmethod
+    def _putsOnSave(obj):
+        """
+        Check whether saving an object puts it as a whole rather than updating its changed columns
+        """
+        if not isinstance(obj, Model):
+            raise ModelError("Non model object found")
+
+        return not obj.isSaved() or not obj.__tracking__
+
+    def _saveQuery(self, obj):
+        """
+        Build an update query setting the changed columns of an object
+        :return: the query, or None if the object has no changes
+        """
+
+        changes = obj.changes()
+        if not changes:
+            return None
+
+        pcol = obj.__columns__[obj.__primary__]
+        return queries.UpdateQuery(obj.tableName(),
+                                   (Filter(obj.__primary__, Condition.EQ, pcol.encode(obj.id)),), *changes)
+
+    def _saveResponse(self, obj, res):
+
+        if self._cache is not None:
+            self._cache.delete((obj.tableName(), obj.id))
+
+        if res.error is not None:
+            raise RequestError("Error saving object: %s", res.error)
+
+        # nothing was updated if the entity was deleted, so the changes weren't saved
+        if res.num:
+            obj.markClean()
+        return res.num
+
+    def _updateResponse(self, model, filters, res):
+
+        self._invalidate(model, filters)
+
+        if res.error is not None:
+            raise RequestError("Error deleting objects: %s", res.error)
+
+        return res.num
+
+
+class Session(_SessionBase):
+
+    def __init__(self, masterConnector = defaultConnector, slaveConnector = defaultConnector, cache=None,
+                 putChunkSize=DEFAULT_PUT_CHUNK_SIZE, putChunkBytes=DEFAULT_PUT_CHUNK_BYTES, coalesce=False):
+        """
+        :param masterConnector: a context manager which yields a client for writes
+        :param slaveConnector: a context manager which yields a client for reads
+        :param cache: an optional LRUCache used as a read-through cache for get() by ids. Objects put, updated or
+        deleted through this session are invalidated in it
+        :param coalesce: if True, concurrent get() calls for the same ids share one request in flight (see Coalescer).
+        The coalescer is available as session.coalescer
+        :param putChunkSize: the maximal number of objects sent in one PUT message. Larger puts are split into
+        chunks pipelined on one connection. None for no limit
+        :param putChunkBytes: the maximal encoded size of a PUT message. Chunks larger than that are split further.
+        None for no limit
+        """
+
+        self._master = masterConnector
+        self._slave = slaveConnector
+        self._cache = cache
+        self.coalescer = Coalescer() if coalesce else None
+        self.putChunkSize = putChunkSize
+        self.putChunkBytes = putChunkBytes
+
+    def select(self, model, filters, **kwargs):
+        """
+        Select objects based on secondary indexes. The model class is used to construct object instances
+        :param model: a model class to create instances from
+        :param filters: a list of filters
+        :param kwargs: extra parameters:
+            * properties - a list of properties to get. The objects are then partial: only these properties are
+            decoded, and they can't be put (see Model.projected)
+            * order - an ordering object (order by ? asc/desc)
+            * paging - start/offset
+            * limit - same as paging but start=0
+            * lazy - if True, return a LazyResult that decodes objects only when they are accessed
+            * columnar - if True, return a dict of column attribute name => array of the column's values instead of
+            objects. See meduza.columnar
+        :return: a list of objects generated from the model class
+        """
+
+        q = self._selectQuery(model, filters, kwargs)
+
+        with self._slave() as client:
+            res = client.do(q)
+
+        return self._loadResponse(model, res, kwargs)
+
 
     def get(self, model,  *ids, **kwargs):
         """
@@ -89,28 +381,95 @@ class Session(object):
         :param model: a model class used to generate objects from the returned entities
         :param ids: a set of id strings
         :param kwargs: extra parameters:
-            * properties - a list of properties to get
+            * properties - a list of properties to get, returning partial objects like in select
         :return: a list of model object instances
 
         """
-        for id in ids:
-            if not isinstance(id, basestring):
-                raise MeduzaError("Invalid id type: %s", type(id))
+        if not kwargs.get('lazy'):
+            if self._cache is not None and not kwargs.get('properties'):
+                return self._cachedGet(model, ids, kwargs)
+            if self.coalescer is not None:
+                return self._decodeRows(model, ids, self._fetchRows(model, ids, kwargs), kwargs)
 
-        q = queries.GetQuery(model.tableName(),
-                    properties=kwargs.get('properties', tuple()))\
-            .filter(model.__primary__, Condition.IN, *ids)\
-            .limit(len(ids))
+        q = self._getQuery(model, ids, kwargs)
 
         with self._slave() as client:
             res = client.do(q)
 
-        if res.error is not None:
-            raise RequestError(res.error)
+        return self._loadResponse(model, res, kwargs)
+
+    def _cachedGet(self, model, ids, kwargs):
+        """
+        Get objects by ids through the cache: only ids missing from the cache are fetched from the server.
+        The cache holds raw entity documents, so every call decodes its own fresh objects
+        """
+
+        table = model.tableName()
+        normalize = model.__columns__[model.__primary__].decode
+
+        rows = {}
+        missing = []
+        for id in ids:
+            id = normalize(id)
+            row = self._cache.get((table, id))
+            if row is None:
+                missing.append(id)
+            else:
+                rows[id] = row
+
+        if missing:
+            fetched = self._fetchRows(model, missing, kwargs)
+            for id, row in fetched.iteritems():
+                self._cache.set((table, id), row)
+            rows.update(fetched)
+
+        return self._decodeRows(model, ids, rows, kwargs)
+
+    def _fetchRows(self, model, ids, kwargs):
+        """
+        Fetch the raw entity documents of ids from the server, through the coalescer if the session has one
+        :return: a dict of normalized id => raw entity document, for the ids found
+        """
+
+        normalize = model.__columns__[model.__primary__].decode
+
+        def fetch(ids):
+            q = self._getQuery(model, ids, kwargs)
+
+            with self._slave() as client:
+                res = client.do(q)
+
+            if res.error is not None:
+                raise RequestError(res.error)
+
+            return [(normalize(row['id']), row) for row in res.rows()]
+
+        if self.coalescer is None:
+            return dict(fetch(ids))
+
+        key = (model.tableName(), tuple(kwargs.get('properties') or ()))
+        ids = [normalize(id) for id in ids]
+        return self.coalescer.fetch(key, ids, fetch)
+
+    def _decodeRows(self, model, ids, rows, kwargs):
+        """
+        Decode raw entity documents into new model objects (or columns), in the order of the ids
+        """
+
+        normalize = model.__columns__[model.__primary__].decode
+
+        st = time.time()
+        # duplicate ids get one object, like they do from the server
+        seen = set()
+        rows = [rows[id] for id in (normalize(id) for id in ids) if id in rows and not (id in seen or seen.add(id))]
+        if kwargs.get('columnar'):
+            objs = decodeColumns(model, rows, kwargs.get('properties'))
+        else:
+            objs = model.projected(kwargs.get('properties')).__batchDecoder__(rows)
+        stats.record(Message.GET, model.tableName(), stats.DECODE, time.time() - st)
 
-        objs = res.load(model)
         if kwargs.get('withTotal'):
-            return objs, res.total
+            return objs, len(rows)
         else:
             return objs
 
@@ -121,6 +480,10 @@ class Session(object):
         If the objects have an id set, it is respected by the server. If not, a new id is generated and the objects
         are filled with their respective ids automatically.
 
+        Large batches are split into chunks of up to putChunkSize objects and putChunkBytes encoded bytes, sent
+        pipelined on one connection. If some chunks fail, the objects of the successful chunks still get their ids,
+        and the first error is raised.
+
         NOTE: All objects must be of the same model class
         :param objects: a list of model objects of the same class
         :param ttl: an integer or float number of seconds for the objects put to live,
@@ -128,35 +491,12 @@ class Session(object):
         :return: the ids resulting from putting the objects into meduza
         """
 
-        q = queries.PutQuery(objects[0].tableName())
-
-        cls = None
-        for obj in objects:
-            if cls is None:
-                cls = obj.__class__
-
-            if obj.__class__ != cls:
-                raise MeduzaError("All objects in a PUT call must be of the same class")
-
-            if not isinstance(obj, Model):
-                raise ModelError("Non model object found")
-
-            ent = obj.encode()
-            if ttl > 0:
-                ent.expire(ttl)
-            q.add(ent)
+        q = self._putQuery(ttl, objects)
 
         with self._master() as client:
-            res = client.do(q)
+            chunks, = client.doChunkedPuts([q], self.putChunkSize, self.putChunkBytes)
 
-        if res.error is not None:
-            raise RequestError("Error putting objects: %s", res.error)
-
-        for i, id in enumerate(res.ids):
-
-            objects[i].setPrimary(id)
-
-        return res.ids
+        return self._chunkedPutResponse(objects, chunks)
 
     def put(self, *objects):
         """
@@ -171,6 +511,57 @@ class Session(object):
 
         return self.putExpiring(-1, *objects)
 
+    def putMany(self, *objects):
+        """
+        Put model objects of any number of models into meduza in one round trip.
+        Objects are grouped by table into one put query per table, and the queries are pipelined together, chunked
+        like in putExpiring. Objects without an id are filled with their new ids.
+        If some puts fail, the objects of the successful ones still get their ids, and the first error is raised.
+        :param objects: a list of model objects
+        :return: the ids of the objects, in the order of the objects
+        """
+
+        groups = self._tablePutGroups(objects)
+        puts = [self._putQuery(-1, group, sameClass=False) for group in groups]
+
+        with self._master() as client:
+            results = client.doChunkedPuts(puts, self.putChunkSize, self.putChunkBytes)
+
+        err = None
+        for group, chunks in zip(groups, results):
+            try:
+                self._chunkedPutResponse(group, chunks)
+            except RequestError as e:
+                err = err or e
+
+        if err is not None:
+            raise err
+
+        return [obj.id for obj in objects]
+
+    def save(self, obj):
+        """
+        Save the changes of a model object since it was loaded or last saved, updating only its changed columns.
+        Objects that were never put (even if they were given an id), and objects of models without change tracking,
+        are put as a whole instead
+        :param obj: a model object
+        :return: the number of updated entities: 1 if the object was updated or put, 0 if it had no changes or its
+        entity no longer exists, in which case the object keeps its changes
+        """
+
+        if self._putsOnSave(obj):
+            self.put(obj)
+            return 1
+
+        q = self._saveQuery(obj)
+        if q is None:
+            return 0
+
+        with self._master() as client:
+            res = client.do(q)
+
+        return self._saveResponse(obj, res)
+
     def delete(self, model, filters):
         """
         Delete from a model, based on a series of filters
@@ -179,21 +570,12 @@ class Session(object):
         :return: the number of entities deleted
         """
 
-        # Filters can be a list of filters or a single filter
-        try:
-            filters = tuple(filters)
-        except TypeError:
-            filters = (filters,)
-
-        q = queries.DelQuery(model.tableName(), *filters)
+        q = self._deleteQuery(model, filters)
 
         with self._master() as client:
             res = client.do(q)
 
-        if res.error is not None:
-            raise RequestError("Error deleting objects: %s", res.error)
-
-        return res.num
+        return self._deleteResponse(model, filters, res)
 
 
     def update(self, model, filters, *deletions, **changes):
@@ -207,32 +589,12 @@ class Session(object):
         :return: the number of updated entities
         """
 
-        # Filters can be a list of filters or a single filter
-        try:
-            filters = tuple(filters)
-        except TypeError:
-            filters = (filters,)
-
-        changeList = list(deletions)
-
-        for k,v in changes.iteritems():
-            if isinstance(v, Change):
-                if k != "_":
-                    assert getattr(model, k).name == v.property, "Mismatching property key and name %s" % k
-                changeList.append(v)
-            else:
-                changeList.append(Change.set(getattr(model, k).name, v))
-
-
-        q = queries.UpdateQuery(model.tableName(), filters, *changeList)
+        q = self._updateQuery(model, filters, deletions, changes)
 
         with self._master() as client:
             res = client.do(q)
 
-        if res.error is not None:
-            raise RequestError("Error deleting objects: %s", res.error)
-
-        return res.num
+        return self._updateResponse(model, filters, res)
 
 
     def count(self, model, filters = None):
@@ -253,20 +615,263 @@ class Session(object):
         _, num = self.select(model, withTotal=True,  limit=1, *filters)
         return num
 
+    def scan(self, model, filters=None, pageSize=DEFAULT_SCAN_PAGE_SIZE, prefetch=1, **kwargs):
+        """
+        Iterate over all the objects matching a set of filters, fetching them page by page.
+        While the caller processes a page, the next pages are fetched by a background thread, so at most
+        prefetch + 2 pages are held in memory at any time.
+        :param model: a model class to create instances from
+        :param filters: a list of filters. If empty, we scan all the objects in the model
+        :param pageSize: the number of objects to fetch per page
+        :param prefetch: the number of pages to fetch ahead in the background. 0 fetches pages only when needed
+        :param kwargs: extra select parameters (properties, order, lazy, columnar)
+        :return: a generator of model objects. In columnar mode, a generator of a columns dict per page
+        """
+
+        filters = self._filterTuple(filters) if filters else (model.all(),)
+        kwargs.pop('withTotal', None)
+        columnar = kwargs.get('columnar')
+        primary = model.__columns__[model.__primary__].modelName
+
+        def fetch(offset):
+            q = self._selectQuery(model, filters, dict(kwargs, paging=Paging(offset, pageSize)))
+            with self._slave() as client:
+                res = client.do(q)
+            return self._loadResponse(model, res, kwargs)
+
+        def rowCount(page):
+            return len(page[primary]) if columnar else len(page)
+
+        if prefetch <= 0:
+            offset = 0
+            while True:
+                page = fetch(offset)
+                if columnar:
+                    yield page
+                else:
+                    for obj in page:
+                        yield obj
+                if rowCount(page) < pageSize:
+                    return
+                offset += pageSize
+
+        pages = Queue.Queue(maxsize=prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def prefetcher():
+            offset = 0
+            try:
+                while True:
+                    page = fetch(offset)
+                    if not put(page) or rowCount(page) < pageSize:
+                        break
+                    offset += pageSize
+            except Exception:
+                put(_ScanEnd(sys.exc_info()))
+            else:
+                put(_ScanEnd(None))
+
+        t = threading.Thread(target=prefetcher, name='meduza-scan-%s' % model.tableName())
+        t.daemon = True
+        t.start()
+
+        try:
+            while True:
+                page = pages.get()
+                if isinstance(page, _ScanEnd):
+                    if page.excInfo is None:
+                        return
+                    raise page.excInfo[0], page.excInfo[1], page.excInfo[2]
+
+                if columnar:
+                    yield page
+                else:
+                    for obj in page:
+                        yield obj
+        finally:
+            stop.set()
+
+    def pipeline(self):
+        """
+        Create a pipeline for sending multiple queries to the server in one round trip.
+        Usage:
+        >> p = session.pipeline()
+        >> p.get(User, "id1", "id2")
+        >> p.update(User, User.id == "id3", name="foo")
+        >> users, numUpdated = p.execute()
+        :return: a Pipeline object bound to this session
+        """
+
+        return Pipeline(self)
+
+
+class _ScanEnd(object):
+    """
+    Marks the end of a scan for its consumer, holding the exception info if the prefetching thread failed
+    """
+    def __init__(self, excInfo):
+        self.excInfo = excInfo
+
+
+class Pipeline(object):
+    """
+    A pipeline queues queries and sends them all to the server in one burst on a single connection, then reads and
+    decodes their responses in order. This saves a network round trip per query.
+
+    Queries are executed on the master connection if any of them is a write, otherwise on the slave connection.
+    The queueing methods mirror the Session methods, and execute() returns their results in the order they were queued
+    """
+
+    def __init__(self, session):
+
+        self._session = session
+        # a list of (query, response handler, is write) tuples
+        self._ops = []
+
+    def __len__(self):
+        return len(self._ops)
+
+    def add(self, query, write=None):
+        """
+        Queue a raw query object. Its result will be the raw response object
+        :param query: a GetQuery/PutQuery/DelQuery/UpdateQuery
+        :param write: whether this is a write query, to be sent to the master. If not given, PutQuery, DelQuery and
+        UpdateQuery objects are writes
+        :return: the pipeline itself for builder-style syntax
+        """
+
+        if write is None:
+            write = isinstance(query, (queries.PutQuery, queries.DelQuery, queries.UpdateQuery))
+
+        def handler(res):
+            if res.error is not None:
+                raise RequestError(res.error)
+            return res
+
+        self._ops.append((query, handler, write))
+        return self
+
+    def select(self, model, filters, **kwargs):
+        """
+        Queue a select. See Session.select
+        """
+        s = self._session
+        self._ops.append((s._selectQuery(model, filters, kwargs),
+                          lambda res: s._loadResponse(model, res, kwargs), False))
+        return self
+
+    def get(self, model, *ids, **kwargs):
+        """
+        Queue a get by ids. See Session.get
+        """
+        s = self._session
+        self._ops.append((s._getQuery(model, ids, kwargs),
+                          lambda res: s._loadResponse(model, res, kwargs), False))
+        return self
+
+    def putExpiring(self, ttl, *objects):
+        """
+        Queue a put of objects with a TTL. The objects' ids are filled when the pipeline is executed.
+        See Session.putExpiring
+        """
+        s = self._session
+        self._ops.append((s._putQuery(ttl, objects), lambda res: s._putResponse(objects, res), True))
+        return self
+
+    def put(self, *objects):
+        """
+        Queue a put of objects. See Session.put
+        """
+        return self.putExpiring(-1, *objects)
+
+    def delete(self, model, filters):
+        """
+        Queue a delete. See Session.delete
+        """
+        s = self._session
+        self._ops.append((s._deleteQuery(model, filters), lambda res: s._deleteResponse(model, filters, res), True))
+        return self
+
+    def update(self, model, filters, *deletions, **changes):
+        """
+        Queue an update. See Session.update
+        """
+        s = self._session
+        self._ops.append((s._updateQuery(model, filters, deletions, changes),
+                          lambda res: s._updateResponse(model, filters, res), True))
+        return self
+
+    def execute(self, raiseOnError=False):
+        """
+        Send all the queued queries in one burst and read their responses.
+        The pipeline is emptied and can be reused afterwards.
+        :param raiseOnError: if True, raise the first error returned by the server. Otherwise errors are returned as
+        RequestError objects in the results list, in place of the failed operation's result
+        :return: a list of the results of the queued operations, in the order they were queued
+        """
+
+        ops, self._ops = self._ops, []
+        if not ops:
+            return []
+
+        connector = self._session._master if any(write for _, _, write in ops) else self._session._slave
+
+        with connector() as client:
+            responses = client.doMany([q for q, _, _ in ops])
+
+        return self._results(ops, responses, raiseOnError)
+
+    @staticmethod
+    def _results(ops, responses, raiseOnError):
+
+        results = []
+        for (_, handler, _), res in zip(ops, responses):
+            try:
+                results.append(handler(res))
+            except RequestError as e:
+                if raiseOnError:
+                    raise
+                results.append(e)
+
+        return results
+
+
 _defaultSession = None
 
 
 
-def setup(masterConnector = defaultConnector, slaveConnector = defaultConnector):
+def setup(masterConnector = defaultConnector, slaveConnector = defaultConnector, cache=None, warmupConnections=0,
+          coalesce=False):
     """
     initialize or reconfigure the global meduza client
     :param masterProvider: a context manager which yields a client
     :param slaveProvider: a context manager which yields a client
+    :param cache: an optional LRUCache for caching gets by id
+    :param warmupConnections: the number of connections to open to the master and slaves right away (see warmup).
+    Warm up failures are logged, not raised, as the connections are opened on demand anyway
+    :param coalesce: if True, concurrent gets of the same ids share one request in flight
     """
     logging.info("Setting up meduza client bandit")
 
     global _defaultSession
-    _defaultSession = Session(masterConnector, slaveConnector)
+    _defaultSession = Session(masterConnector, slaveConnector, cache, coalesce=coalesce)
+
+    if warmupConnections:
+        connectors = [masterConnector] if slaveConnector is masterConnector else [masterConnector, slaveConnector]
+        for connector in connectors:
+            try:
+                warmup(connector, warmupConnections)
+            except Exception:
+                logging.exception("Error warming up meduza connections")
 
 
 def select(model, filters, **kwargs):
@@ -281,6 +886,8 @@ def select(model, filters, **kwargs):
         * paging - start/offset
         * limit - same as paging but start=0
         * withTotal - if set to True we also return a total of the rows matching this query
+        * lazy - if True, return a LazyResult that decodes objects only when they are accessed
+        * columnar - if True, return a dict of column attribute name => array of the column's values
     :return: a list of objects generated from the model class
     """
 
@@ -309,6 +916,14 @@ def put(*objects):
     """
     return _defaultSession.put(*objects)
 
+def putMany(*objects):
+    """
+    Put model objects of any number of models into meduza in one round trip, using the Default Session
+    :param objects: a list of model objects
+    :return: the ids of the objects, in the order of the objects
+    """
+    return _defaultSession.putMany(*objects)
+
 def putExpiring(ttl, *objects):
     """
     Put a bunch of model objects into meduza with a TTL expiration in seconds
@@ -324,6 +939,15 @@ def putExpiring(ttl, *objects):
     return _defaultSession.putExpiring(ttl, *objects)
 
 
+def save(obj):
+    """
+    Save the changed columns of a model object using the default session. See Session.save
+    :param obj: a model object
+    :return: the number of updated entities: 1 if the object was updated or put, 0 if it had no changes
+    """
+    return _defaultSession.save(obj)
+
+
 def delete(model, filters):
     """
     Delete from a model, based on a series of filters using the Default Session
@@ -345,6 +969,21 @@ def update(model, filters, *deletions, **changes):
     """
     return _defaultSession.update(model, filters, *deletions, **changes)
 
+def scan(model, filters=None, pageSize=DEFAULT_SCAN_PAGE_SIZE, prefetch=1, **kwargs):
+    """
+    Iterate over all the objects matching a set of filters using the default session, fetching pages in the
+    background. See Session.scan
+    :return: a generator of model objects
+    """
+    return _defaultSession.scan(model, filters, pageSize, prefetch, **kwargs)
+
+def pipeline():
+    """
+    Create a pipeline on the default session, for sending multiple queries in one round trip
+    :return: a Pipeline object
+    """
+    return _defaultSession.pipeline()
+
 def count(model, filters=tuple()):
 
     return _defaultSession.count(model, filters)
\ No newline at end of file
@@ -0,0 +1,394 @@
+"""
+An asyncio client and session for meduza.
+
+This module speaks the same RESP + BSON protocol as the blocking RedisClient, over asyncio streams. Queries are
+multiplexed on a small pool of connections: each connection can have many queries in flight, and since the server
+answers them in order, responses are matched to their queries by a FIFO of pending futures.
+
+Since this library runs on Python 2, it is built on trollius, the asyncio port for Python 2. Coroutines here are
+generator based, so you use them with `res = yield From(session.get(User, id))`.
+"""
+import collections
+import time
+
+import trollius as asyncio
+from trollius import From, Return
+
+from . import _SessionBase, Pipeline
+from .client import BsonProtocol, Message, packCommand, recordedDecode
+from .errors import MeduzaError, RequestError
+
+__author__ = 'dvirsky'
+
+
+DEFAULT_POOL_SIZE = 4
+
+
+class ReplyError(MeduzaError):
+    """
+    A RESP error reply sent by the server
+    """
+    pass
+
+
+@asyncio.coroutine
+def readReply(reader):
+    """
+    Read a single RESP reply from a stream reader
+    :return: the decoded reply. Error replies are returned (not raised) as ReplyError objects
+    """
+
+    line = yield From(reader.readline())
+    if not line.endswith('\r\n'):
+        raise MeduzaError("Connection closed by server")
+
+    prefix, rest = line[0], line[1:-2]
+
+    if prefix == '+':
+        raise Return(rest)
+    elif prefix == '-':
+        raise Return(ReplyError(rest))
+    elif prefix == ':':
+        raise Return(int(rest))
+    elif prefix == '$':
+        n = int(rest)
+        if n < 0:
+            raise Return(None)
+        data = yield From(reader.readexactly(n + 2))
+        raise Return(data[:-2])
+    elif prefix == '*':
+        n = int(rest)
+        if n < 0:
+            raise Return(None)
+        ret = []
+        for _ in xrange(n):
+            item = yield From(readReply(reader))
+            ret.append(item)
+        raise Return(ret)
+
+    raise MeduzaError("Invalid RESP reply: %r" % line)
+
+
+class AsyncConnection(object):
+    """
+    A single server connection that can have many pipelined requests in flight.
+    Requests are written as soon as they are made, and a background reader task resolves their futures in order
+    """
+
+    def __init__(self, host, port, loop=None):
+
+        self.host = host
+        self.port = port
+        self._loop = loop or asyncio.get_event_loop()
+        self._reader = None
+        self._writer = None
+        self._readTask = None
+        self._connectLock = asyncio.Lock(loop=self._loop)
+        self._pending = collections.deque()
+
+    @property
+    def pending(self):
+        """
+        The number of requests waiting for a response on this connection
+        """
+        return len(self._pending)
+
+    @asyncio.coroutine
+    def connect(self):
+        """
+        Connect to the server if we are not connected yet
+        """
+
+        if self._writer is not None:
+            return
+
+        with (yield From(self._connectLock)):
+            if self._writer is not None:
+                return
+
+            reader, writer = yield From(asyncio.open_connection(self.host, self.port, loop=self._loop))
+            self._reader, self._writer = reader, writer
+            self._readTask = asyncio.ensure_future(self._readLoop(reader), loop=self._loop)
+
+    @asyncio.coroutine
+    def request(self, msgs):
+        """
+        Send a batch of serialized messages in one write and wait for their responses
+        :param msgs: a list of Message objects
+        :return: a list of response Message objects, in the order of the requests
+        """
+
+        yield From(self.connect())
+
+        futures = []
+        for _ in msgs:
+            f = asyncio.Future(loop=self._loop)
+            self._pending.append(f)
+            futures.append(f)
+
+        self._writer.write(''.join(packCommand(msg.type, msg.body) for msg in msgs))
+        yield From(self._writer.drain())
+
+        replies = yield From(asyncio.gather(*futures, loop=self._loop))
+
+        raise Return([Message(*r) for r in replies])
+
+    def close(self):
+        """
+        Close the connection, failing all the requests still waiting for a response
+        """
+        if self._writer is not None:
+            self._writer.close()
+        self._reset(MeduzaError("Connection closed"))
+
+    @asyncio.coroutine
+    def _readLoop(self, reader):
+
+        try:
+            while True:
+                reply = yield From(readReply(reader))
+                f = self._pending.popleft()
+                # the caller might have given up on this request, but we still had to consume its response
+                if f.cancelled():
+                    continue
+
+                if isinstance(reply, ReplyError):
+                    f.set_exception(RequestError(str(reply)))
+                else:
+                    f.set_result(reply)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            if reader is self._reader:
+                # we are the read task, no need to cancel ourselves
+                self._readTask = None
+                if self._writer is not None:
+                    self._writer.close()
+                self._reset(e)
+
+    def _reset(self, err):
+
+        if self._readTask is not None and not self._readTask.done():
+            self._readTask.cancel()
+
+        self._reader = self._writer = self._readTask = None
+
+        pending, self._pending = self._pending, collections.deque()
+        for f in pending:
+            if not f.done():
+                f.set_exception(err)
+
+
+class AsyncRedisClient(object):
+    """
+    An asyncio counterpart of RedisClient, with the same RESP + BSON framing.
+    Queries are spread over a pool of connections, choosing the connection with the fewest requests in flight.
+    A single client can be shared by all the coroutines running on its event loop
+    """
+
+    def __init__(self, host='localhost', port=9977, timeout=None, poolSize=DEFAULT_POOL_SIZE, loop=None):
+        """
+        :param timeout: seconds to wait for a response before raising a TimeoutError. None to wait forever
+        :param poolSize: the number of connections to open to the server
+        """
+
+        self._loop = loop or asyncio.get_event_loop()
+        self._conns = [AsyncConnection(host, port, self._loop) for _ in xrange(poolSize)]
+        self._proto = BsonProtocol()
+        self.timeout = timeout
+
+    @asyncio.coroutine
+    def do(self, query):
+        """
+        Send a query to the server and receive its response
+        :param query: a query object
+        :return: a response object
+        """
+
+        ret = yield From(self.doMany([query]))
+        raise Return(ret[0])
+
+    @asyncio.coroutine
+    def doMany(self, queries):
+        """
+        Pipeline a batch of queries on one connection
+        :param queries: a list of query objects
+        :return: a list of response objects, matching the order of the queries
+        """
+
+        if not queries:
+            raise Return([])
+
+        msgs = []
+        serializeTimes = []
+        for q in queries:
+            st = time.time()
+            msgs.append(self._proto.encodeMessage(q))
+            serializeTimes.append(time.time() - st)
+
+        conn = min(self._conns, key=lambda c: c.pending)
+        req = conn.request(msgs)
+        if self.timeout is not None:
+            req = asyncio.wait_for(req, self.timeout, loop=self._loop)
+
+        sent = time.time()
+        replies = yield From(req)
+        network = time.time() - sent
+
+        raise Return([recordedDecode(self._proto, q, msg.type, reply, serializeTime, network)
+                      for q, msg, reply, serializeTime in zip(queries, msgs, replies, serializeTimes)])
+
+    def close(self):
+        """
+        Close all the client's connections
+        """
+        for conn in self._conns:
+            conn.close()
+
+
+class AsyncPipeline(Pipeline):
+    """
+    A pipeline for AsyncSession, sending its queries in one burst on a single connection
+    """
+
+    @asyncio.coroutine
+    def execute(self, raiseOnError=False):
+        """
+        Send all the queued queries in one burst and read their responses. See Pipeline.execute
+        """
+
+        ops, self._ops = self._ops, []
+        if not ops:
+            raise Return([])
+
+        s = self._session
+        client = s._masterClient if any(write for _, _, write in ops) else s._slaveClient
+        responses = yield From(client.doMany([q for q, _, _ in ops]))
+
+        raise Return(self._results(ops, responses, raiseOnError))
+
+
+class AsyncSession(_SessionBase):
+    """
+    An asyncio counterpart of Session. All the query methods are coroutines, with the same arguments and results
+    as their Session counterparts. Caching, coalescing, chunked puts and scan are not supported.
+    """
+
+    def __init__(self, masterClient, slaveClient=None):
+        """
+        :param masterClient: an AsyncRedisClient for writes (and reads if slaveClient is not set)
+        :param slaveClient: an AsyncRedisClient for reads
+        """
+        self._masterClient = masterClient
+        self._slaveClient = slaveClient or masterClient
+
+    @asyncio.coroutine
+    def select(self, model, filters, **kwargs):
+        """
+        Select objects based on secondary indexes. See Session.select
+        """
+        q = self._selectQuery(model, filters, kwargs)
+        res = yield From(self._slaveClient.do(q))
+
+        raise Return(self._loadResponse(model, res, kwargs))
+
+    @asyncio.coroutine
+    def get(self, model, *ids, **kwargs):
+        """
+        Get objects by id(s). See Session.get
+        """
+        q = self._getQuery(model, ids, kwargs)
+        res = yield From(self._slaveClient.do(q))
+
+        raise Return(self._loadResponse(model, res, kwargs))
+
+    @asyncio.coroutine
+    def putExpiring(self, ttl, *objects):
+        """
+        Put model objects with a TTL expiration in seconds. See Session.putExpiring
+        """
+        q = self._putQuery(ttl, objects)
+        res = yield From(self._masterClient.do(q))
+
+        raise Return(self._putResponse(objects, res))
+
+    @asyncio.coroutine
+    def put(self, *objects):
+        """
+        Put model objects. See Session.put
+        """
+        ret = yield From(self.putExpiring(-1, *objects))
+        raise Return(ret)
+
+    @asyncio.coroutine
+    def putMany(self, *objects):
+        """
+        Put model objects of any number of models in one round trip. See Session.putMany
+        """
+        groups = self._tablePutGroups(objects)
+        responses = yield From(self._masterClient.doMany([self._putQuery(-1, group, sameClass=False)
+                                                          for group in groups]))
+
+        err = None
+        for group, res in zip(groups, responses):
+            try:
+                self._putResponse(group, res)
+            except RequestError as e:
+                err = err or e
+
+        if err is not None:
+            raise err
+
+        raise Return([obj.id for obj in objects])
+
+    @asyncio.coroutine
+    def save(self, obj):
+        """
+        Save the changes of a model object. See Session.save
+        """
+        if self._putsOnSave(obj):
+            yield From(self.put(obj))
+            raise Return(1)
+
+        q = self._saveQuery(obj)
+        if q is None:
+            raise Return(0)
+
+        res = yield From(self._masterClient.do(q))
+        raise Return(self._saveResponse(obj, res))
+
+    @asyncio.coroutine
+    def delete(self, model, filters):
+        """
+        Delete objects matching a series of filters. See Session.delete
+        """
+        q = self._deleteQuery(model, filters)
+        res = yield From(self._masterClient.do(q))
+
+        raise Return(self._deleteResponse(model, filters, res))
+
+    @asyncio.coroutine
+    def update(self, model, filters, *deletions, **changes):
+        """
+        Update objects matching a series of filters. See Session.update
+        """
+        q = self._updateQuery(model, filters, deletions, changes)
+        res = yield From(self._masterClient.do(q))
+
+        raise Return(self._updateResponse(model, filters, res))
+
+    @asyncio.coroutine
+    def count(self, model, filters=None):
+        """
+        Count the total number of objects matching a set of filters. See Session.count
+        """
+        filters = self._filterTuple(filters) if filters else (model.all(),)
+
+        _, num = yield From(self.select(model, filters, withTotal=True, limit=1))
+        raise Return(num)
+
+    def pipeline(self):
+        """
+        Create a pipeline for sending multiple queries to the server in one round trip. See Session.pipeline
+        """
+        return AsyncPipeline(self)
@@ -0,0 +1,510 @@
+"""
+Micro benchmarks for the hot paths of the meduza client: query serialization, BSON message encoding and decoding,
+model encoding and decoding and the column codecs, at different row counts and column mixes. The per instance
+memory of regular and compact model objects is reported too.
+
+Run with `python -m meduza.bench`. Results can be saved as JSON and compared to find regressions:
+
+    python -m meduza.bench --out before.json
+    ... change things ...
+    python -m meduza.bench --out after.json
+    python -m meduza.bench --compare before.json after.json
+"""
+import argparse
+import datetime
+import json
+import platform
+import sys
+import time
+import timeit
+
+import bson
+
+from .client import BsonProtocol, Message, dictify, _serializers
+from .model import Model
+from .columns import Column, Text, Int, Float, Bool, Set, List, Map, Timestamp, Binary
+from .queries import GetQuery, PutQuery, Condition
+
+__author__ = 'dvirsky'
+
+
+DEFAULT_ROWS = (10, 1000)
+DEFAULT_REPEAT = 5
+# the minimal time of each timing run, we call the benchmarked function as many times as needed to reach it
+MIN_RUN_TIME = 0.02
+DEFAULT_THRESHOLD = 0.1
+# the size of the Binary and Text values of the payload benchmarks, and the maximal number of rows they use
+PAYLOAD_SIZE = 128 * 1024
+PAYLOAD_ROWS = 100
+
+
+class NarrowUser(Model):
+    _schema = 'bench'
+    _table = 'NarrowUsers'
+
+    name = Text("name", required=True)
+    email = Text("email")
+
+
+class WideUser(Model):
+    _schema = 'bench'
+    _table = 'WideUsers'
+
+    name = Text("name", required=True)
+    email = Text("email")
+    score = Int("score")
+    balance = Float("balance")
+    active = Bool("active")
+    groups = Set("groups", type=Text())
+    tags = List("tags", type=Text())
+    attrs = Map("attrs", type=Text())
+    registered = Timestamp("registered")
+
+
+class LegacyWideUser(WideUser):
+    """
+    WideUser with the Model.__getattribute__ override that used to resolve unset columns to their zero value,
+    kept for comparing attribute access cost
+    """
+
+    def __getattribute__(self, item):
+        ret = object.__getattribute__(self, item)
+
+        if isinstance(ret, Column):
+            return ret.zero
+        return ret
+
+
+class CompactWideUser(Model):
+    """
+    WideUser storing its columns in __slots__
+    """
+    _schema = 'bench'
+    _table = 'WideUsers'
+    __compact__ = True
+
+    name = Text("name", required=True)
+    email = Text("email")
+    score = Int("score")
+    balance = Float("balance")
+    active = Bool("active")
+    groups = Set("groups", type=Text())
+    tags = List("tags", type=Text())
+    attrs = Map("attrs", type=Text())
+    registered = Timestamp("registered")
+
+
+MIXES = {
+    'narrow': NarrowUser,
+    'wide': WideUser,
+}
+
+
+def makeValue(col, i, now):
+    """
+    Create a column value the way it is returned from the server
+    """
+    if isinstance(col, Text):
+        return u'value %d' % i
+    elif isinstance(col, Bool):
+        return bool(i % 2)
+    elif isinstance(col, Int):
+        return i
+    elif isinstance(col, Float):
+        return i * 0.5
+    elif isinstance(col, Timestamp):
+        return now
+    elif isinstance(col, Set):
+        return [Set.IDENT, u'g%d' % (i % 10), u'all']
+    elif isinstance(col, List):
+        return [List.IDENT, u'a', u'b%d' % i]
+    elif isinstance(col, Map):
+        return {u'k1': u'v%d' % i, u'k2': u'x'}
+    elif isinstance(col, Binary):
+        return bson.Binary('\0' * 64)
+
+    raise ValueError("No bench value for %s" % type(col))
+
+
+def makeRows(model, num):
+    """
+    Create raw entity documents the way they are returned from the server
+    :return: a list of {'id': ..., 'properties': {...}} dicts
+    """
+    now = datetime.datetime.utcnow()
+    cols = [(k, col) for k, col in model.__columns__.iteritems() if k != model.__primary__]
+
+    return [{'id': u'id%d' % i, 'properties': {k: makeValue(col, i, now) for k, col in cols}} for i in xrange(num)]
+
+
+def makeObjects(model, num):
+
+    decode = model.__decoder__
+    return [decode(r['id'], r['properties']) for r in makeRows(model, num)]
+
+
+def makePutQuery(model, num):
+
+    return PutQuery(model.tableName(), *[obj.encode() for obj in makeObjects(model, num)])
+
+
+class Benchmark(object):
+    """
+    A single benchmark case: a function doing some work on a number of rows.
+    The setup function is called once before timing, and returns the benchmarked function
+    """
+
+    def __init__(self, name, rows, setup):
+        self.name = name
+        self.rows = rows
+        self.setup = setup
+
+    def run(self, repeat=DEFAULT_REPEAT):
+        """
+        Time the benchmark
+        :return: a dict with the ops per second, seconds per op and seconds per row
+        """
+
+        func = self.setup()
+
+        # calibrate the number of calls per timing run
+        number = 1
+        while True:
+            t = timeit.timeit(func, number=number)
+            if t >= MIN_RUN_TIME:
+                break
+            number = max(number * 2, int(number * MIN_RUN_TIME / t) + 1) if t > 0 else number * 10
+
+        perOp = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+        return {
+            'rows': self.rows,
+            'opsPerSec': 1.0 / perOp,
+            'perOp': perOp,
+            'perRow': perOp / self.rows,
+        }
+
+
+def columnBenchmarks(rows):
+    """
+    Benchmark each column type's decode and encode over a column of values
+    """
+
+    cols = [Text('text'), Int('int'), Float('float'), Bool('bool'), Timestamp('timestamp'),
+            Set('set', type=Text()), List('list', type=Text()), Map('map', type=Text()), Binary('binary')]
+
+    ret = []
+    for col in cols:
+        name = type(col).__name__
+
+        def decodeSetup(col=col):
+            now = datetime.datetime.utcnow()
+            values = [makeValue(col, i, now) for i in xrange(rows)]
+            decode = col.decode
+            return lambda: [decode(v) for v in values]
+
+        def encodeSetup(col=col):
+            now = datetime.datetime.utcnow()
+            values = [col.decode(makeValue(col, i, now)) for i in xrange(rows)]
+            encode = col.encode
+            return lambda: [encode(v) for v in values]
+
+        def decodeManySetup(col=col):
+            now = datetime.datetime.utcnow()
+            values = [makeValue(col, i, now) for i in xrange(rows)]
+            return lambda: col.decodeMany(values)
+
+        def encodeManySetup(col=col):
+            now = datetime.datetime.utcnow()
+            values = col.decodeMany([makeValue(col, i, now) for i in xrange(rows)])
+            return lambda: col.encodeMany(values)
+
+        ret.append(Benchmark('column.%s.decode[%d]' % (name, rows), rows, decodeSetup))
+        ret.append(Benchmark('column.%s.encode[%d]' % (name, rows), rows, encodeSetup))
+        ret.append(Benchmark('column.%s.decodeMany[%d]' % (name, rows), rows, decodeManySetup))
+        ret.append(Benchmark('column.%s.encodeMany[%d]' % (name, rows), rows, encodeManySetup))
+
+    return ret
+
+
+def modelBenchmarks(mix, model, rows):
+    """
+    Benchmark query serialization, message encoding/decoding and model encoding/decoding for a model
+    """
+
+    proto = BsonProtocol()
+    label = '%s,%d' % (mix, rows)
+
+    def dictifyPut():
+        q = makePutQuery(model, rows)
+        return lambda: dictify(q)
+
+    def serializePut():
+        q = makePutQuery(model, rows)
+        serialize = _serializers[PutQuery]
+        return lambda: serialize(q)
+
+    def encodePut():
+        q = makePutQuery(model, rows)
+        return lambda: proto.encodeMessage(q)
+
+    def encodeGet():
+        q = GetQuery(model.tableName()).filter(model.__primary__, Condition.IN,
+                                               *['id%d' % i for i in xrange(rows)]).limit(rows)
+        return lambda: proto.encodeMessage(q)
+
+    def decodeGet():
+        msg = Message(Message.GET_RESPONSE, bson.BSON.encode({
+            'Response': {'error': None, 'time': 0},
+            'entities': makeRows(model, rows),
+            'total': rows,
+        }))
+        return lambda: proto.decodeMessage(msg).load(model)
+
+    def decodeModel():
+        docs = makeRows(model, rows)
+        decode = model.__decoder__
+        return lambda: [decode(d['id'], d['properties']) for d in docs]
+
+    def encodeModel():
+        objs = makeObjects(model, rows)
+        return lambda: [obj.encode() for obj in objs]
+
+    def batchDecodeModel():
+        docs = makeRows(model, rows)
+        return lambda: model.__batchDecoder__(docs)
+
+    def batchEncodeModel():
+        objs = makeObjects(model, rows)
+        return lambda: model.__batchEncoder__(objs)
+
+    return [
+        Benchmark('dictify.put[%s]' % label, rows, dictifyPut),
+        Benchmark('serialize.put[%s]' % label, rows, serializePut),
+        Benchmark('encodeMessage.put[%s]' % label, rows, encodePut),
+        Benchmark('encodeMessage.get[%s]' % label, rows, encodeGet),
+        Benchmark('decodeMessage.get[%s]' % label, rows, decodeGet),
+        Benchmark('model.decode[%s]' % label, rows, decodeModel),
+        Benchmark('model.encode[%s]' % label, rows, encodeModel),
+        Benchmark('model.batchDecode[%s]' % label, rows, batchDecodeModel),
+        Benchmark('model.batchEncode[%s]' % label, rows, batchEncodeModel),
+    ]
+
+
+def attributeBenchmarks(rows):
+    """
+    Benchmark attribute access on decoded objects, comparing descriptor based column defaults to the legacy
+    __getattribute__ override
+    """
+
+    def setup(model, attr):
+        objs = makeObjects(model, rows)
+        for obj in objs:
+            del obj.__dict__['email']
+        return lambda: [getattr(obj, attr) for obj in objs]
+
+    ret = []
+    for label, model in (('descriptor', WideUser), ('legacy', LegacyWideUser)):
+        for case, attr in (('set', 'name'), ('unset', 'email'), ('method', 'setPrimary')):
+            ret.append(Benchmark('attributes.%s.%s[%d]' % (case, label, rows), rows,
+                                 lambda model=model, attr=attr: setup(model, attr)))
+
+    return ret
+
+
+def payloadBenchmarks(rows):
+    """
+    Benchmark decoding and encoding of large Binary and Text values, comparing copying columns to zero copy ones.
+    Values are decoded from a BSON document like they are in responses
+    """
+
+    rows = min(rows, PAYLOAD_ROWS)
+
+    def values(col):
+        if isinstance(col, Binary):
+            value = bson.Binary('\xab' * PAYLOAD_SIZE)
+        else:
+            value = u'\u05d0' * (PAYLOAD_SIZE / 2)
+        # each value gets its own buffer, like values decoded from a response
+        return bson.BSON.encode({'v': [value] * rows}).decode()['v']
+
+    def decodeSetup(col):
+        vals = values(col)
+        return lambda: col.decodeMany(vals)
+
+    def encodeSetup(col):
+        vals = col.decodeMany(values(col))
+        return lambda: col.encodeMany(vals)
+
+    ret = []
+    for mode, zeroCopy in (('copy', False), ('zeroCopy', True)):
+        for col in (Binary('binary', zeroCopy=zeroCopy), Text('text', zeroCopy=zeroCopy)):
+            name = type(col).__name__
+            ret.append(Benchmark('payload.%s.decode.%s[%d]' % (name, mode, rows), rows,
+                                 lambda col=col: decodeSetup(col)))
+            ret.append(Benchmark('payload.%s.encode.%s[%d]' % (name, mode, rows), rows,
+                                 lambda col=col: encodeSetup(col)))
+
+    return ret
+
+
+def compactBenchmarks(rows):
+    """
+    Benchmark decoding and attribute access of regular objects against compact, __slots__ based ones
+    """
+
+    def decodeSetup(model):
+        docs = makeRows(model, rows)
+        decode = model.__decoder__
+        return lambda: [decode(d['id'], d['properties']) for d in docs]
+
+    def accessSetup(model):
+        objs = makeObjects(model, rows)
+        return lambda: [obj.name for obj in objs]
+
+    ret = []
+    for label, model in (('dict', WideUser), ('compact', CompactWideUser)):
+        ret.append(Benchmark('compact.decode.%s[%d]' % (label, rows), rows, lambda model=model: decodeSetup(model)))
+        ret.append(Benchmark('compact.access.%s[%d]' % (label, rows), rows, lambda model=model: accessSetup(model)))
+
+    return ret
+
+
+def instanceSize(obj):
+    """
+    The memory taken by an object and its attribute dict, if it has one. Attribute values are not counted, as they
+    are the same in both modes
+    """
+
+    size = sys.getsizeof(obj)
+    d = getattr(obj, '__dict__', None)
+    if d is not None:
+        size += sys.getsizeof(d)
+
+    return size
+
+
+def memoryUsage():
+    """
+    Measure the per instance memory of fully loaded regular and compact objects
+    :return: a dict of mode => bytes per instance
+    """
+
+    return {label: instanceSize(makeObjects(model, 1)[0])
+            for label, model in (('dict', WideUser), ('compact', CompactWideUser))}
+
+
+def benchmarks(rowCounts=DEFAULT_ROWS):
+    """
+    Get all the benchmarks for the given row counts
+    :return: a list of Benchmark objects
+    """
+
+    ret = []
+    for rows in rowCounts:
+        for mix, model in sorted(MIXES.iteritems()):
+            ret += modelBenchmarks(mix, model, rows)
+        ret += columnBenchmarks(rows)
+        ret += attributeBenchmarks(rows)
+        ret += compactBenchmarks(rows)
+        ret += payloadBenchmarks(rows)
+
+    return ret
+
+
+def run(rowCounts=DEFAULT_ROWS, repeat=DEFAULT_REPEAT, match=None, out=sys.stdout):
+    """
+    Run the benchmarks, printing the results as they are measured
+    :param match: only run benchmarks whose name contains this string
+    :return: a results dict that can be saved as JSON
+    """
+
+    results = {}
+    for b in benchmarks(rowCounts):
+        if match and match not in b.name:
+            continue
+
+        res = results[b.name] = b.run(repeat)
+        if out is not None:
+            out.write('%-45s %12.1f ops/s %10.3f us/row\n' % (b.name, res['opsPerSec'], res['perRow'] * 1e6))
+            out.flush()
+
+    memory = memoryUsage()
+    if out is not None:
+        for label, size in sorted(memory.iteritems()):
+            out.write('%-45s %12d bytes/instance\n' % ('memory.%s' % label, size))
+
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'bsonC': bson.has_c(),
+            'time': time.time(),
+            'rows': list(rowCounts),
+            'repeat': repeat,
+        },
+        'results': results,
+        'memory': memory,
+    }
+
+
+def compare(base, current, threshold=DEFAULT_THRESHOLD, out=sys.stdout):
+    """
+    Compare two benchmark runs
+    :param base: the results dict of the baseline run
+    :param current: the results dict of the current run
+    :param threshold: the relative slowdown in per row time above which a benchmark is considered a regression
+    :return: a list of the names of regressed benchmarks
+    """
+
+    regressions = []
+    for name in sorted(set(base['results']) & set(current['results'])):
+        b, c = base['results'][name], current['results'][name]
+        change = c['perRow'] / b['perRow'] - 1
+
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+
+        if out is not None:
+            out.write('%-45s %10.3f -> %10.3f us/row %+7.1f%%%s\n' % (
+                name, b['perRow'] * 1e6, c['perRow'] * 1e6, change * 100, flag))
+
+    return regressions
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Run meduza client micro benchmarks")
+    parser.add_argument('--rows', default=','.join(map(str, DEFAULT_ROWS)),
+                        help="comma separated row counts to run each benchmark with")
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help="number of timing runs per benchmark")
+    parser.add_argument('--match', help="only run benchmarks whose name contains this string")
+    parser.add_argument('--out', help="write the results as JSON to this file")
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'CURRENT'),
+                        help="compare two JSON result files instead of running benchmarks")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="relative slowdown considered a regression when comparing")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            base = json.load(f)
+        with open(args.compare[1]) as f:
+            current = json.load(f)
+
+        regressions = compare(base, current, args.threshold)
+        return 1 if regressions else 0
+
+    results = run([int(r) for r in args.rows.split(',')], args.repeat, args.match)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+__author__ = 'dvirsky'
+
+import collections
+import threading
+import time
+
+
+DEFAULT_MAX_SIZE = 10000
+DEFAULT_TTL = 60.0
+
+
+class LRUCache(object):
+    """
+    A thread safe, size bounded LRU cache whose entries expire ttl seconds after they were set.
+    When the cache is full, setting a new key evicts the least recently used entry.
+
+    A Session can use it as a read-through cache for gets by id. See Session.__init__
+    """
+
+    def __init__(self, maxSize=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL):
+        """
+        :param maxSize: the maximal number of entries in the cache
+        :param ttl: seconds an entry stays valid after it is set. None or 0 for entries that never expire
+        """
+        if maxSize <= 0:
+            raise ValueError("Invalid cache size: %s" % maxSize)
+
+        self.maxSize = maxSize
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        # key => (value, expiration time), least recently used first
+        self._entries = collections.OrderedDict()
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._invalidations = 0
+
+    def get(self, key):
+        """
+        Get the value of a key, marking it as recently used
+        :return: the value, or None if the key is not in the cache or has expired
+        """
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self._misses += 1
+                return None
+
+            if entry[1] is not None and entry[1] < time.time():
+                self._expirations += 1
+                self._misses += 1
+                return None
+
+            self._entries[key] = entry
+            self._hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        """
+        Set the value of a key, evicting the least recently used entry if the cache is full
+        """
+        expires = time.time() + self.ttl if self.ttl else None
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+
+            if len(self._entries) > self.maxSize:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def delete(self, *keys):
+        """
+        Remove keys from the cache
+        """
+        with self._lock:
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self._invalidations += 1
+
+    def deleteIf(self, predicate):
+        """
+        Remove all the keys matching a predicate from the cache
+        :param predicate: a function taking a key and returning True if it should be removed
+        """
+        with self._lock:
+            keys = [k for k in self._entries if predicate(k)]
+            for key in keys:
+                del self._entries[key]
+            self._invalidations += len(keys)
+
+    def clear(self):
+
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """
+        Get the cache counters
+        :return: a dict with the cache size, hits, misses, evictions of least recently used entries, expirations
+        and invalidations
+        """
+        with self._lock:
+            return {
+                'maxSize': self.maxSize,
+                'size': len(self._entries),
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'expirations': self._expirations,
+                'invalidations': self._invalidations,
+            }
@@ -1,14 +1,21 @@
 __author__ = 'dvirsky'
 
 import logging
+import os
 import types
 import redis
 import bson
 from bson.errors import BSONError
 import time
 import datetime
+import threading
+import itertools
+from contextlib import contextmanager
 
 from . import queries
+from . import stats
+from .errors import MeduzaError
+from .pool import ConnectionPool, DEFAULT_MAX_SIZE, DEFAULT_IDLE_TIMEOUT, DEFAULT_WAIT_TIMEOUT
 
 
 
@@ -84,7 +91,7 @@ class BsonProtocol(object):
         """
 
         try:
-            d = dictify(data)
+            d = _serializers.get(type(data), dictify)(data)
         except Exception as e:
             logging.exception("Could not dictify object %s", data)
             raise e
@@ -162,9 +169,113 @@ def dictify(obj):
     return dictify(obj.__dict__)
 
 
+# Values that BSON can encode as they are. Column encoders only produce these, so entity properties skip dictify
+__passthrough = __primitives | {list, dict, bson.Binary}
+
+
+def serializeFilters(filters):
+    """
+    Serialize a query's filters dict (property => Filter)
+    """
+
+    ret = {}
+    for k, flt in filters.iteritems():
+        if type(flt) is queries.Filter:
+            ret[k] = {'property': flt.property, 'op': flt.op,
+                      'values': [v if type(v) in __primitives else dictify(v) for v in flt.values]}
+        else:
+            ret[k] = dictify(flt)
+
+    return ret
+
+
+def serializeEntity(ent):
+
+    props = {}
+    for k, v in ent.properties.iteritems():
+        props[k] = v if type(v) in __passthrough else dictify(v)
+
+    return {'id': ent.id, 'properties': props, 'ttl': ent.ttl}
+
+
+def serializeGetQuery(q):
+
+    order = q.order
+    if type(order) is queries.Ordering:
+        order = {'by': order.by, 'asc': order.asc}
+    elif order is not None:
+        order = dictify(order)
+
+    return {
+        'table': q.table,
+        'properties': list(q.properties),
+        'filters': serializeFilters(q.filters),
+        'order': order,
+        'paging': {'offset': q.paging.offset, 'limit': q.paging.limit} if q.paging is not None else None,
+    }
+
+
+def serializePutQuery(q):
+
+    return {'table': q.table, 'entities': [serializeEntity(e) for e in q.entities]}
+
+
+def serializeDelQuery(q):
+
+    return {'table': q.table, 'filters': serializeFilters(q.filters)}
+
+
+def serializeUpdateQuery(q):
+
+    return {
+        'table': q.table,
+        'filters': serializeFilters(q.filters),
+        'changes': [{'property': c.property, 'op': c.op,
+                     'value': c.value if type(c.value) in __passthrough else dictify(c.value)} for c in q.changes],
+    }
+
+
+def serializePingQuery(q):
+
+    return {}
+
+
+# Hand built serializers per query class, producing the same documents as dictify without its generic recursion.
+# Objects of classes not registered here are serialized with dictify
+_serializers = {
+    queries.GetQuery: serializeGetQuery,
+    queries.PutQuery: serializePutQuery,
+    queries.DelQuery: serializeDelQuery,
+    queries.UpdateQuery: serializeUpdateQuery,
+    queries.PingQuery: serializePingQuery,
+}
+
+
+def registerSerializer(cls, serializer):
+    """
+    Register a function that serializes objects of a class into BSON encodable documents, replacing dictify for them
+    :param cls: the object class, matched exactly (not including subclasses)
+    :param serializer: a function taking an object and returning a dict
+    """
+    _serializers[cls] = serializer
 
 
 
+
+
+def packCommand(*args):
+    """
+    Encode a command as a RESP array of bulk strings
+    """
+    out = ['*%d\r\n' % len(args)]
+    for arg in args:
+        out.append('$%d\r\n' % len(arg))
+        out.append(arg)
+        out.append('\r\n')
+
+    return ''.join(out)
+
+
 class RedisTransport(object):
     """
     Transport represents a single server connection that can read and write messages.
@@ -176,10 +287,31 @@ class RedisTransport(object):
         We initialize the transport with a redis connection pool from which it takes a connection
         """
 
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+        self._pid = os.getpid()
         self._conn = redis.Connection(host,port, socket_timeout=timeout)
 
         assert(isinstance(self._conn, redis.Connection))
 
+    def _checkPid(self):
+        """
+        If we were forked since the connection was opened, the socket is shared with the parent process, and using it
+        would corrupt both processes' streams. We replace the connection with a new one, leaving the inherited socket
+        alone: shutting it down would break the parent's connection
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._conn = redis.Connection(self.host, self.port, socket_timeout=self.timeout)
+
+    def connect(self):
+        """
+        Connect to the server now rather than on the first message
+        """
+        self._checkPid()
+        self._conn.connect()
 
     def sendMessage(self, msg):
         """
@@ -187,9 +319,19 @@ class RedisTransport(object):
         :param msg: a serialized message
         """
         assert(isinstance(msg, Message))
+        self._checkPid()
         self._conn.connect()
         self._conn.send_command(msg.type, msg.body)
 
+    def sendMessages(self, msgs):
+        """
+        Send a batch of serialized messages to the server in one write, for pipelining.
+        :param msgs: a list of serialized messages
+        """
+        self._checkPid()
+        self._conn.connect()
+        self._conn.send_packed_command(self._conn.pack_commands([(msg.type, msg.body) for msg in msgs]))
+
     def receiveMessage(self):
         """
         Receive a single serialized message from the server.
@@ -200,6 +342,13 @@ class RedisTransport(object):
 
         return Message(msgType, body)
 
+    def close(self):
+        """
+        Close the underlying server connection. The transport reconnects automatically when used again
+        """
+        if self._pid == os.getpid():
+            self._conn.disconnect()
+
 
 
 class RedisClient(object):
@@ -207,59 +356,319 @@ class RedisClient(object):
     A client connects to the server using redis' RESP protocol,
     sends commands and receives responses, taking care of serialization.
 
-    You can use a single redis client per app, as it is thread safe and uses a redis connection pool internally.
+    You can use a single redis client per app from many threads: unless it is bound to a transport, each round trip
+    borrows a connection from the process wide pool of its server (see getPool), so concurrent callers never share a
+    connection. Queries sent with send()/sendMany() keep their thread's connection until all their responses are
+    received.
     """
 
-    def __init__(self, host='localhost', port=9977, timeout=None):
+    def __init__(self, host='localhost', port=9977, timeout=None, transport=None):
+        """
+        :param transport: an existing transport to work on (e.g. one taken from a connection pool). A client bound to
+        a transport must not be shared between threads. If not given, connections are taken from the pool of host and
+        port for each round trip
+        """
 
-        self._transport = RedisTransport(host, port, timeout)
+        self._transport = transport
+        self._pool = getPool(host, port, timeout) if transport is None else None
+        self._local = threading.local()
         self._proto = BsonProtocol()
 
+    @contextmanager
+    def _connection(self):
+        """
+        Use a transport for one round trip: the bound transport, or a connection borrowed from the pool.
+        Round trips do not use the connection pinned by send(), so they never read responses meant for receive()
+        """
+
+        if self._pool is None:
+            yield self._transport
+            return
+
+        with self._pool.connection() as transport:
+            yield transport
+
+    def _pin(self):
+        """
+        Get the transport of this thread's pending send() calls, borrowing one from the pool if there are none
+        """
+
+        if self._pool is None:
+            return self._transport
 
+        transport = getattr(self._local, 'transport', None)
+        if transport is None:
+            transport = self._local.transport = self._pool.acquire()
+            self._local.pending = 0
+
+        return transport
+
+    def _unpin(self, failed=False):
+        """
+        Return this thread's pinned transport to the pool, or discard it if it failed
+        """
+
+        transport, self._local.transport = self._local.transport, None
+        if failed:
+            self._pool.discard(transport)
+        else:
+            self._pool.release(transport)
 
     def send(self, query):
         """
         Send a query to the server (without receiving the response)
         * Do not use this method unless for pipelining, use do() instead for single queries *
         :param query: a query object
-        :param transport: a redis transport.
         :return:
         """
 
         msg = self._proto.encodeMessage(query)
-
-        self._transport.sendMessage(msg)
+        self._sendPinned([msg])
 
     def receive(self):
         """
         Received a response from the server and deserialize it into a response object
         * Do not use this method unless for pipelining, use do() instead for single queries *
-        :param transport: a redis transport.
         :return:
         """
-        msg = self._transport.receiveMessage()
-        return  self._proto.decodeMessage(msg)
 
+        if self._pool is None:
+            return self._proto.decodeMessage(self._transport.receiveMessage())
+
+        if getattr(self._local, 'transport', None) is None:
+            raise MeduzaError("No response to receive, nothing was sent from this thread")
+
+        try:
+            msg = self._local.transport.receiveMessage()
+        except:
+            self._unpin(failed=True)
+            raise
+
+        self._local.pending -= 1
+        if not self._local.pending:
+            self._unpin()
+
+        return self._proto.decodeMessage(msg)
+
+    def _sendPinned(self, msgs):
+
+        transport = self._pin()
+        try:
+            transport.sendMessages(msgs)
+        except:
+            if self._pool is not None:
+                self._unpin(failed=True)
+            raise
+
+        if self._pool is not None:
+            self._local.pending += len(msgs)
 
     def do(self, query):
         """
-        Send a query to the server and receive its response
+        Send a query to the server and receive its response.
+        The time spent on each phase of the round trip is recorded in meduza.stats
         :param query: a query object
         :return: a response object
         """
 
-        self.send(query)
+        st = time.time()
+        msg = self._proto.encodeMessage(query)
+        sent = time.time()
+
+        with self._connection() as transport:
+            transport.sendMessage(msg)
+            resp = transport.receiveMessage()
+        received = time.time()
+
+        res = self._proto.decodeMessage(resp)
+
+        if stats.enabled:
+            stats.recordQuery(msg.type, getattr(query, 'table', ''), sent - st, received - sent,
+                              time.time() - received, res.time)
+        return res
+
+    def sendMany(self, queries):
+        """
+        Send a batch of queries to the server in a single write (without receiving the responses)
+        * Do not use this method unless for pipelining, use doMany() instead *
+        :param queries: a list of query objects
+        """
+
+        msgs = [self._proto.encodeMessage(q) for q in queries]
+
+        self._sendPinned(msgs)
+
+    def receiveMany(self, num):
+        """
+        Receive and deserialize num responses from the server, in the order their queries were sent
+        * Do not use this method unless for pipelining, use doMany() instead *
+        :return: a list of response objects
+        """
+
+        return [self.receive() for _ in xrange(num)]
+
+    def doMany(self, queries):
+        """
+        Pipeline a batch of queries: send them all to the server in one burst, then read all their responses.
+        Stats are recorded per query, with the network time of each being the time of the whole batch round trip
+        :param queries: a list of query objects
+        :return: a list of response objects, matching the order of the queries
+        """
+
+        if not queries:
+            return []
+
+        msgs = []
+        serializeTimes = []
+        for q in queries:
+            st = time.time()
+            msgs.append(self._proto.encodeMessage(q))
+            serializeTimes.append(time.time() - st)
+
+        return self._roundTrip(queries, msgs, serializeTimes)
+
+    def doChunkedPuts(self, puts, maxEntities=None, maxBytes=None):
+        """
+        Send put queries split into chunks, all pipelined on this client's connection.
+        A chunk whose encoded message is larger than maxBytes is split in half until it fits or holds a single entity
+        :param puts: a list of PutQuery objects
+        :param maxEntities: the maximal number of entities in a chunk. None for no limit
+        :param maxBytes: the maximal encoded size in bytes of a chunk's message. None for no limit
+        :return: a list with an item per query, of (number of entities, PutResponse) tuples, one per chunk in the
+        order of the query's entities
+        """
+
+        chunks = []
+        msgs = []
+        serializeTimes = []
+        counts = []
+        for query in puts:
+            entities = query.entities
+            step = maxEntities or len(entities) or 1
+            # a stack of entity lists still to encode, with the next chunk on top
+            pending = [entities[i:i + step] for i in xrange(0, len(entities), step)] or [[]]
+            pending.reverse()
+
+            n = 0
+            while pending:
+                ents = pending.pop()
+                q = queries.PutQuery(query.table, *ents)
 
-        return self.receive()
+                st = time.time()
+                msg = self._proto.encodeMessage(q)
+                serializeTime = time.time() - st
 
+                if maxBytes and len(msg.body) > maxBytes and len(ents) > 1:
+                    half = len(ents) / 2
+                    pending.append(ents[half:])
+                    pending.append(ents[:half])
+                    continue
 
+                chunks.append(q)
+                msgs.append(msg)
+                serializeTimes.append(serializeTime)
+                n += 1
 
+            counts.append(n)
 
+        responses = iter(zip(chunks, self._roundTrip(chunks, msgs, serializeTimes)))
 
+        return [[(len(q.entities), res) for q, res in itertools.islice(responses, n)] for n in counts]
 
+    def _roundTrip(self, queries, msgs, serializeTimes):
+        """
+        Send encoded messages in a single write, then receive and decode their responses
+        :return: a list of response objects, matching the order of the messages
+        """
+
+        sent = time.time()
+        with self._connection() as transport:
+            transport.sendMessages(msgs)
+            resps = [transport.receiveMessage() for _ in xrange(len(msgs))]
+        network = time.time() - sent
+
+        if not stats.enabled:
+            return [self._proto.decodeMessage(resp) for resp in resps]
 
+        return [recordedDecode(self._proto, q, msg.type, resp, serializeTime, network)
+                for q, msg, resp, serializeTime in zip(queries, msgs, resps, serializeTimes)]
+
+
+def recordedDecode(proto, query, msgType, resp, serializeTime, networkTime):
+    """
+    Decode a response message, recording the query's stats
+    :return: the decoded response
+    """
 
+    st = time.time()
+    res = proto.decodeMessage(resp)
+    stats.recordQuery(msgType, getattr(query, 'table', ''), serializeTime, networkTime, time.time() - st, res.time)
 
+    return res
+
+
+_pools = {}
+_poolsLock = threading.Lock()
+
+
+def getPool(host='localhost', port=9977, timeout=None, maxSize=DEFAULT_MAX_SIZE, idleTimeout=DEFAULT_IDLE_TIMEOUT,
+            waitTimeout=DEFAULT_WAIT_TIMEOUT):
+    """
+    Get the process wide connection pool for a server, creating it if needed.
+    Pools are keyed by the server and all the pool settings, so all connectors to the same server with the same
+    settings share connections, and connectors asking for different settings get pools of their own.
+    :return: a ConnectionPool of RedisTransport objects
+    """
+
+    key = (host, port, timeout, maxSize, idleTimeout, waitTimeout)
+    with _poolsLock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(lambda: RedisTransport(host, port, timeout), maxSize=maxSize,
+                                  idleTimeout=idleTimeout, waitTimeout=waitTimeout)
+            _pools[key] = pool
+
+    return pool
+
+
+def warmPool(pool, connections):
+    """
+    Open connections in a pool of RedisTransport objects ahead of the first requests, pinging the server on each
+    :param connections: the number of connections to open, capped by the pool size
+    """
+
+    transports = []
+    try:
+        for _ in xrange(min(connections, pool.maxSize)):
+            transport = pool.acquire()
+            try:
+                res = RedisClient(transport=transport).do(queries.PingQuery())
+            except:
+                pool.discard(transport)
+                raise
+
+            if res.error is not None:
+                pool.discard(transport)
+                raise MeduzaError("Error pinging %s:%s: %s" % (transport.host, transport.port, res.error))
+            transports.append(transport)
+    finally:
+        for transport in transports:
+            pool.release(transport)
+
+
+def poolStats():
+    """
+    Get the usage stats of all connection pools in this process
+    :return: a dict of "host:port" => a list of the stats dicts of the server's pools (one per set of pool settings),
+    each with the pool's settings
+    """
 
+    with _poolsLock:
+        pools = _pools.items()
 
+    ret = {}
+    for (host, port, timeout, _, idleTimeout, waitTimeout), pool in pools:
+        ret.setdefault('%s:%s' % (host, port), []).append(dict(pool.stats(), timeout=timeout, idleTimeout=idleTimeout,
+                                                               waitTimeout=waitTimeout))
 
+    return ret
@@ -0,0 +1,103 @@
+__author__ = 'dvirsky'
+
+import sys
+import threading
+
+
+class _Flight(object):
+    """
+    A GET request in flight, shared by all the callers waiting for any of its ids
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        # normalized id => raw entity document
+        self.rows = {}
+        self.excInfo = None
+
+
+class Coalescer(object):
+    """
+    Single-flight coalescing of concurrent gets by id.
+    A caller asking for ids that are already being fetched by another caller waits for that request instead of
+    sending its own. The ids nobody is fetching yet are fetched together in one IN query, which later callers can
+    join in turn. Callers share the raw entity documents, so each of them decodes its own model objects.
+
+    A Session can use it to coalesce its gets. See Session.__init__
+    """
+
+    def __init__(self):
+
+        self._lock = threading.Lock()
+        # (table, properties, normalized id) => the _Flight fetching it
+        self._flights = {}
+
+        self._requests = 0
+        self._fetched = 0
+        self._joined = 0
+
+    def fetch(self, key, ids, fetch):
+        """
+        Get the raw entity documents of ids, joining the requests in flight for some of them and fetching the rest
+        :param key: a hashable identifying the table and the query parameters other than the ids
+        :param ids: a list of normalized ids
+        :param fetch: a function taking a list of ids and returning a list of (normalized id, raw entity document)
+        tuples for the ids found. It is called by this thread only, at most once
+        :return: a dict of normalized id => raw entity document, for the ids found
+        """
+
+        mine = _Flight()
+        missing = []
+        joined = {}
+
+        with self._lock:
+            for id in ids:
+                flight = self._flights.get((key, id))
+                if flight is None:
+                    self._flights[(key, id)] = mine
+                    missing.append(id)
+                elif flight is not mine:
+                    joined[id] = flight
+
+            if missing:
+                self._requests += 1
+                self._fetched += len(missing)
+            self._joined += len(joined)
+
+        if missing:
+            try:
+                mine.rows.update(fetch(missing))
+            except Exception:
+                mine.excInfo = sys.exc_info()
+            finally:
+                with self._lock:
+                    for id in missing:
+                        del self._flights[(key, id)]
+                mine.done.set()
+
+            if mine.excInfo is not None:
+                raise mine.excInfo[0], mine.excInfo[1], mine.excInfo[2]
+
+        rows = {id: mine.rows[id] for id in missing if id in mine.rows}
+        for id, flight in joined.iteritems():
+            flight.done.wait()
+            if flight.excInfo is not None:
+                raise flight.excInfo[0], flight.excInfo[1], flight.excInfo[2]
+            if id in flight.rows:
+                rows[id] = flight.rows[id]
+
+        return rows
+
+    def stats(self):
+        """
+        Get the coalescer counters
+        :return: a dict with the number of requests in flight, requests sent, ids fetched by them and ids that
+        joined a request sent by another caller
+        """
+        with self._lock:
+            return {
+                'inFlight': len(set(self._flights.itervalues())),
+                'requests': self._requests,
+                'fetched': self._fetched,
+                'joined': self._joined,
+            }
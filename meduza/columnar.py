@@ -0,0 +1,97 @@
+"""
+Columnar decoding of result sets, for analytics over many rows without creating an object per row.
+
+Numeric, boolean and timestamp columns become typed NumPy arrays if NumPy is installed, or array module arrays
+otherwise (with timestamps as seconds since the epoch). All other columns become lists of decoded values.
+NumPy is only imported by the first columnar decoding, as importing it takes longer than importing the rest of meduza.
+"""
+import array
+import calendar
+
+__author__ = 'dvirsky'
+
+
+_UNLOADED = object()
+# the numpy module once loaded, None if it is not installed
+numpy = _UNLOADED
+
+
+def _numpy():
+    """
+    Import NumPy on first use
+    :return: the numpy module, or None if it is not installed
+    """
+    global numpy
+
+    if numpy is _UNLOADED:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+
+    return numpy
+
+
+def _epoch(dt):
+    """
+    Convert a naive UTC datetime to seconds since the epoch
+    """
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+
+def columnArray(col, values):
+    """
+    Convert decoded values of a column into its columnar form
+    :param col: the column
+    :param values: a list of decoded values, None for rows where the column is not set
+    :return: a typed array for columns with a dtype, otherwise the list of values
+    """
+
+    if col.dtype is None:
+        return values
+
+    isTime = col.dtype.startswith('datetime64')
+    # unset numbers read as their zero value, unset timestamps as NaT/NaN
+    missing = None if isTime else col.zero
+
+    if missing is not None:
+        values = [missing if v is None else v for v in values]
+
+    np = _numpy()
+    if np is not None:
+        return np.array(values, dtype=col.dtype)
+
+    if isTime:
+        nan = float('nan')
+        values = [nan if v is None else _epoch(v) for v in values]
+
+    return array.array(col.typecode, values)
+
+
+def decodeColumns(model, rows, properties=None):
+    """
+    Decode raw entity documents into one array per column
+    :param model: the model class whose columns are decoded
+    :param rows: a list of {'id': ..., 'properties': {...}} documents
+    :param properties: if set, only decode these (server side) properties
+    :return: a dict of column attribute name => array or list, with the ids as a list under the primary key's name
+    """
+
+    primary = model.__columns__[model.__primary__]
+    ret = {primary.modelName: primary.decodeMany([row['id'] for row in rows])}
+
+    for k, col in model.__columns__.iteritems():
+        if col is primary or (properties and k not in properties):
+            continue
+
+        values = [row['properties'].get(k) for row in rows]
+        present = [v for v in values if v is not None]
+        if len(present) == len(values):
+            values = col.decodeMany(values)
+        else:
+            decoded = iter(col.decodeMany(present))
+            values = [next(decoded) if v is not None else None for v in values]
+
+        ret[col.modelName] = columnArray(col, values)
+
+    return ret
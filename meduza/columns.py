@@ -13,6 +13,12 @@ class Column(object):
 
     Undefined = object()
     zero = None
+    # the NumPy dtype and array module typecode of columnar results (see meduza.columnar). None for lists
+    dtype = None
+    typecode = None
+    # whether values can be changed in place. Model objects keep a copy (see copy()) of these columns' values, to
+    # detect changes that were not assignments
+    mutable = False
 
     def __init__(self, name='', default = Undefined, required=False, choices = None):
 
@@ -27,6 +33,40 @@ class Column(object):
 
 
 
+    def __get__(self, instance, owner):
+        """
+        Columns are non-data descriptors: values set on an object live in its __dict__ and take precedence, so only
+        unset columns get here, returning the column's zero value. On the model class itself we return the column
+        """
+        if instance is None:
+            return self
+
+        return self.zero
+
+    def copy(self, value):
+        """
+        Copy a decoded value of a mutable column, so that changes made to the value in place don't affect the copy
+        """
+        return value
+
+    def decodeMany(self, values):
+        """
+        Decode a column of values at once. Subclasses override this with faster paths than decoding value by value
+        :param values: a list of raw values
+        :return: a list of decoded values
+        """
+        decode = self.decode
+        return [decode(v) for v in values]
+
+    def encodeMany(self, values):
+        """
+        Encode a column of values at once. Subclasses override this with faster paths than encoding value by value
+        :param values: a list of values
+        :return: a list of encoded values
+        """
+        encode = self.encode
+        return [encode(v) for v in values]
+
     def default(self):
 
         if callable(self._default):
@@ -82,6 +122,7 @@ class Column(object):
 
 
 NIL = '{NIL}'
+_UNICODE_NIL = u'{NIL}'
 
 
 class Key(Column):
@@ -101,8 +142,23 @@ class Key(Column):
         elif isinstance(data, unicode):
             return data.encode('utf-8')
 
+        # don't copy values that are str already
+        elif data.__class__ is str:
+            return data
+
         return '%s' % data
 
+    def decodeMany(self, values):
+
+        decode = self.decode
+        ret = [v.encode('utf-8') if v.__class__ is unicode else decode(v) for v in values]
+
+        # unicode NILs were encoded above. NIL in values would be slow for unicode values
+        if NIL in ret:
+            ret = [None if v == NIL else v for v in ret]
+
+        return ret
+
     def encode(self, data):
 
         if data == NIL or data is None:
@@ -112,6 +168,8 @@ class Key(Column):
             return data.encode('utf-8')
         elif isinstance(data, bson.Binary):
             return str(data)
+        elif data.__class__ is str:
+            return data
 
         return '%s' % data
 
@@ -125,10 +183,15 @@ class Text(Column):
 
     zero = ""
 
-    def __init__(self, name='', maxLen=-1, **kwargs):
+    def __init__(self, name='', maxLen=-1, zeroCopy=False, **kwargs):
+        """
+        :param zeroCopy: if True, values are passed through unchanged when they are strings already. Decoded values
+        are then unicode objects as they come from BSON, instead of utf-8 encoded str copies
+        """
 
         Column.__init__(self, name=name, **kwargs)
         self.maxLen = maxLen
+        self.zeroCopy = zeroCopy
 
 
     def decode(self, data):
@@ -141,18 +204,57 @@ class Text(Column):
             raise ColumnValueError("Value for %s too large, allowed %d, have %d" % (self.name, self.maxLen, len(data)))
 
         if isinstance(data, unicode):
-            return data.encode('utf-8')
+            return data if self.zeroCopy else data.encode('utf-8')
+
+        elif data.__class__ is str:
+            return data
 
         return '%s' % data
 
+    def decodeMany(self, values):
+
+        if self.maxLen > 0:
+            return Column.decodeMany(self, values)
+
+        decode = self.decode
+        if self.zeroCopy:
+            ret = [v if v.__class__ is unicode else decode(v) for v in values]
+            # decode() took care of the NILs that weren't unicode. Looking for the str NIL among unicode values would
+            # be slow, as each comparison decodes it
+            if _UNICODE_NIL in ret:
+                ret = [None if v.__class__ is unicode and v == _UNICODE_NIL else v for v in ret]
+            return ret
+
+        ret = [v.encode('utf-8') if v.__class__ is unicode else decode(v) for v in values]
+
+        # unicode NILs were encoded above. NIL in values would be slow for unicode values
+        if NIL in ret:
+            ret = [None if v == NIL else v for v in ret]
+
+        return ret
+
+    def encodeMany(self, values):
+
+        encode = self.encode
+        if self.zeroCopy:
+            ret = [v if v.__class__ is str or v.__class__ is unicode else encode(v) for v in values]
+        else:
+            ret = [v if v.__class__ is str else encode(v) for v in values]
+
+        if NIL in ret:
+            ret = [None if v == NIL else v for v in ret]
+
+        return ret
+
     def encode(self, data):
 
         if data is None or data == NIL:
             return None
 
-        # encode unicode to utr
+        # encode unicode to utr. BSON encodes unicode as is, so in zero copy mode we leave it
         if isinstance(data, unicode):
-            data = data.encode('utf-8')
+            if not self.zeroCopy:
+                data = data.encode('utf-8')
 
         #encode everything else to str
         elif not isinstance(data, str):
@@ -165,7 +267,8 @@ class Text(Column):
 class Int(Column):
     """ Representing an integer column """
     zero = 0
-
+    dtype = 'int64'
+    typecode = 'l'
 
     def decode(self, data):
         return int(data) if data is not None else None
@@ -173,6 +276,11 @@ class Int(Column):
     def encode(self, data):
         return int(data) if data is not None else None
 
+    def decodeMany(self, values):
+        return map(int, values) if None not in values else Column.decodeMany(self, values)
+
+    encodeMany = decodeMany
+
 import math
 
 class Uint(Column):
@@ -180,30 +288,89 @@ class Uint(Column):
     Representing an unsigned integer column
     """
     zero = 0
+    dtype = 'uint64'
+    typecode = 'L'
+
     def decode(self, data):
-        long(-data if data < 0 else data) if data is not None else None
+        return long(-data if data < 0 else data) if data is not None else None
 
     def encode(self, data):
-        long(-data if data < 0 else data) if data is not None else None
+        return long(-data if data < 0 else data) if data is not None else None
 
 class Float(Column):
     """ Representing an integer column """
     zero = 0.0
+    dtype = 'float64'
+    typecode = 'd'
+
     def decode(self, data):
         return float(data) if data is not None else None
 
     def encode(self, data):
         return float(data) if data is not None else None
 
+    def decodeMany(self, values):
+        return map(float, values) if None not in values else Column.decodeMany(self, values)
+
+    encodeMany = decodeMany
+
 class Binary(Column):
-    """ Representing an integer column """
+    """
+    Representing a binary column.
+    Values are decoded and encoded as bytearray copies. In zero copy mode, values decoded from BSON are returned as
+    the read only bson.Binary objects BSON decoding created, and other buffers as memoryviews over them. Values are
+    encoded as bson.Binary, copying only values that aren't bson.Binary already
+    """
+
+    def __init__(self, name='', zeroCopy=False, **kwargs):
+
+        Column.__init__(self, name=name, **kwargs)
+        self.zeroCopy = zeroCopy
+        # bytearrays can be changed in place, zero copy values can't
+        self.mutable = not zeroCopy
+
+    def copy(self, value):
+        return str(value) if value is not None else None
+
     def decode(self, data):
-        return bytearray(data) if data is not None else None
+        if data is None:
+            return None
+
+        if self.zeroCopy:
+            return data if isinstance(data, str) else memoryview(data)
+
+        return bytearray(data)
 
     def encode(self, data):
-        return bytearray(data) if data is not None else None
+        if data is None:
+            return None
+
+        if self.zeroCopy:
+            if data.__class__ is bson.Binary:
+                return data
+            return bson.Binary(data.tobytes() if isinstance(data, memoryview) else str(data))
+
+        # BSON can't encode bytearrays
+        return bson.Binary(str(data))
+
+    def decodeMany(self, values):
+        if self.zeroCopy:
+            decode = self.decode
+            return [v if v.__class__ is bson.Binary or v is None else decode(v) for v in values]
+
+        return [bytearray(v) if v is not None else None for v in values]
+
+    def encodeMany(self, values):
+        if self.zeroCopy:
+            encode = self.encode
+            return [v if v.__class__ is bson.Binary or v is None else encode(v) for v in values]
+
+        return [bson.Binary(str(v)) if v is not None else None for v in values]
 
 class Timestamp(Column):
+    # array module columns hold seconds since the epoch, NaN for unset values
+    dtype = 'datetime64[us]'
+    typecode = 'd'
 
     @classmethod
     def now(cls):
@@ -223,18 +390,30 @@ class Timestamp(Column):
 
         raise ColumnValueError("Invalid value for datetime: %s"%data)
 
+    def decodeMany(self, values):
+
+        # values usually come from BSON as datetimes already
+        decode = self.decode
+        dt = datetime.datetime
+        return [v if v.__class__ is dt else decode(v) for v in values]
+
     def encode(self, data):
         if data is None:
             d = self.default()
-            if d is not None:
+            if d is not None and d is not Column.Undefined:
                 return self.encode(d)
 
         return self.decode(data)
 
+    def encodeMany(self, values):
+        return self.decodeMany(values) if None not in values else Column.encodeMany(self, values)
+
 
 
 class Bool(Column):
     zero = False
+    dtype = 'bool'
+    typecode = 'b'
 
     def decode(self, data):
 
@@ -253,6 +432,13 @@ class Bool(Column):
     def encode(self, data):
         return self.decode(data)
 
+    def decodeMany(self, values):
+
+        decode = self.decode
+        return [v if v.__class__ is bool else decode(v) for v in values]
+
+    encodeMany = decodeMany
+
 
 class Set(Column):
     """
@@ -260,6 +446,7 @@ class Set(Column):
     """
 
     IDENT = '__MDZS__'
+    mutable = True
 
     def __init__(self, name, type=None, default = Column.Undefined):
 
@@ -267,6 +454,9 @@ class Set(Column):
         Column.__init__(self, name, default=default)
         self._type = type
 
+    def copy(self, value):
+        return set(value) if value is not None else None
+
 
     def decode(self, data):
 
@@ -276,7 +466,26 @@ class Set(Column):
         if not isinstance(data, (list, tuple)):
             raise MeduzaError("Invalid type for decoded set: %s", type(data))
 
-        return set(filter(lambda x: x != self.IDENT, (self._type.decode(e) for e in data)))
+        ident = self.IDENT
+        decode = self._type.decode
+        return {decode(e) for e in data if e != ident}
+
+    def decodeMany(self, values):
+
+        ident = self.IDENT
+        decodeElements = self._type.decodeMany
+        ret = []
+        for data in values:
+            if data is None or data == NIL:
+                ret.append(None)
+            elif isinstance(data, (list, tuple)):
+                elements = set(data)
+                elements.discard(ident)
+                ret.append(set(decodeElements(list(elements))))
+            else:
+                raise MeduzaError("Invalid type for decoded set: %s", type(data))
+
+        return ret
 
 
     def encode(self, data):
@@ -297,6 +506,7 @@ class List(Column):
     """
 
     IDENT = '__MDZL__'
+    mutable = True
 
     def __init__(self, name, type=None, default = Column.Undefined):
 
@@ -304,6 +514,9 @@ class List(Column):
         Column.__init__(self, name, default=default)
         self._type = type
 
+    def copy(self, value):
+        return list(value) if value is not None else None
+
 
     def decode(self, data):
 
@@ -314,7 +527,24 @@ class List(Column):
             raise MeduzaError("Invalid type for decoded set: %s", type(data))
 
 
-        return filter(lambda x: x != self.IDENT, (self._type.decode(e) for e in data))
+        ident = self.IDENT
+        decode = self._type.decode
+        return [decode(e) for e in data if e != ident]
+
+    def decodeMany(self, values):
+
+        ident = self.IDENT
+        decodeElements = self._type.decodeMany
+        ret = []
+        for data in values:
+            if data is None or data == NIL:
+                ret.append(None)
+            elif isinstance(data, (list, tuple)):
+                ret.append(decodeElements([e for e in data if e != ident]))
+            else:
+                raise MeduzaError("Invalid type for decoded set: %s", type(data))
+
+        return ret
 
 
     def encode(self, data):
@@ -335,12 +565,17 @@ class Map(Column):
     Representing a list column
     """
 
+    mutable = True
+
     def __init__(self, name, type=None, default = Column.Undefined):
 
 
         Column.__init__(self, name, default=default)
         self._type = type
 
+    def copy(self, value):
+        return dict(value) if value is not None else None
+
 
     def decode(self, data):
 
@@ -352,6 +587,13 @@ class Map(Column):
 
         return {k: self._type.decode(v) for k,v in data.iteritems()}
 
+    def decodeMany(self, values):
+
+        decode = self.decode
+        decodeValue = self._type.decode
+        return [{k: decodeValue(v) for k, v in data.iteritems()} if data.__class__ is dict else decode(data)
+                for data in values]
+
 
 
     def encode(self, data):
@@ -364,3 +606,10 @@ class Map(Column):
 
         return {k: self._type.encode(v) for k,v in data.iteritems()}
 
+    def encodeMany(self, values):
+
+        encode = self.encode
+        encodeValue = self._type.encode
+        return [{k: encodeValue(v) for k, v in data.iteritems()} if data.__class__ is dict else encode(data)
+                for data in values]
+
@@ -10,4 +10,7 @@ class ModelError(MeduzaError):
     pass
 
 class RequestError(MeduzaError):
-    pass
\ No newline at end of file
+    pass
+
+class PoolExhaustedError(MeduzaError):
+    pass
@@ -1,11 +1,13 @@
-from meduza.errors import ColumnValueError
+from meduza.errors import ColumnValueError, ModelError
 
 __author__ = 'dvirsky'
 
+import itertools
 import logging
+import re
 
 from .columns import Column, Key
-from .queries import Filter, Condition, Entity
+from .queries import Filter, Condition, Entity, Change
 
 
 ID = "id"
@@ -13,7 +15,15 @@ ID = "id"
 
 class ModelType(type):
     """
-    Meta class for models, it injects the member name in a model of fields into the columns
+    Meta class for models, it injects the member name in a model of fields into the columns.
+
+    Models setting __compact__ = True store their columns in __slots__ instead of a per object __dict__, which saves
+    a lot of memory when holding many objects. Compact objects can only hold column attributes, and column access is
+    a bit slower. Compact models can only derive from Model or other compact models, and their subclasses are compact
+    too.
+
+    Models setting __tracking__ = False don't track the assignments to their columns, which makes assignments as fast
+    as plain attribute assignments. Session.save puts their objects as a whole
     """
     def __new__(mcs, name, bases, dct):
         # Copy all of the base Models columns into our subclass columns
@@ -33,6 +43,18 @@ class ModelType(type):
 
         dct['__columns__'] = columns
 
+        compact = dct.get('__compact__') or any(getattr(base, '__compact__', False) for base in bases)
+        if compact:
+            dct['__compact__'] = True
+            # columns inherited from compact bases already have their slots
+            slotted = {col.modelName for base in bases if getattr(base, '__compact__', False)
+                       for col in base.__columns__.itervalues()}
+            dct['__slots__'] = tuple(_slotName(col.modelName) for col in columns.itervalues()
+                                     if col.modelName not in slotted)
+
+        if dct.get('__tracking__') is False:
+            dct['__setattr__'] = object.__setattr__
+
         for k, v in columns.iteritems():
             if v.primary:
                 dct['__primary__'] = k
@@ -40,7 +62,310 @@ class ModelType(type):
         else:
             raise RuntimeError('Model {} has no primary key'.format(name))
 
-        return type.__new__(mcs, name, bases, dct)
+        cls = type.__new__(mcs, name, bases, dct)
+
+        if compact:
+            if cls.__dictoffset__:
+                raise ModelError('Compact model {} can only derive from Model and compact models'.format(name))
+
+            for col in columns.itervalues():
+                setattr(cls, col.modelName, _CompactColumn(col, getattr(cls, _slotName(col.modelName))))
+
+        cls.__tracked__ = {col.modelName: col for col in columns.itervalues() if not col.primary}
+        cls.__mutable__ = {attr: col for attr, col in cls.__tracked__.iteritems() if col.mutable}
+
+        cls.__decoder__, cls.__encoder__, cls.__batchDecoder__, cls.__batchEncoder__ = \
+            _compileCodecs(cls, dct.get('__projection__'))
+        cls.__projections__ = {}
+
+        return cls
+
+
+_MISSING = object()
+_setattr = object.__setattr__
+
+
+def _slotName(modelName):
+    """
+    The name of the slot holding a column's value in compact objects
+    """
+    return '_c_%s' % modelName
+
+
+class _CompactColumn(object):
+    """
+    Exposes a column stored in a slot of compact model objects. Unset columns read as the column's zero value, and
+    on the model class itself we return the column, like Column does for regular models
+    """
+
+    __slots__ = ('column', 'slot')
+
+    def __init__(self, column, slot):
+        self.column = column
+        self.slot = slot
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self.column
+
+        try:
+            return self.slot.__get__(instance, owner)
+        except AttributeError:
+            return self.column.zero
+
+    def __set__(self, instance, value):
+        self.slot.__set__(instance, value)
+
+    def __delete__(self, instance):
+        self.slot.__delete__(instance)
+
+
+def _newProjected(cls, properties):
+    """
+    Create an empty object of a projected class when unpickling. See _reduceProjected
+    """
+    return object.__new__(cls.projected(properties))
+
+
+def _reduceProjected(obj, protocol):
+    """
+    Pickle objects of projected classes, which can't be found by their name, through the model they are projected from
+    """
+    return _newProjected, (obj.__class__.__bases__[0], obj.__projection__), obj.__getstate__()
+
+
+def _unmapped(cls, properties, strict):
+    """
+    Warn about entity properties that are not columns of the model. Called by compiled decoders
+    """
+    if not strict:
+        return
+
+    for k in properties:
+        if k != cls.__primary__ and k not in cls.__columns__:
+            logging.warn("Could not map %s to object - not in model", k)
+
+
+def _partialEncoder(obj):
+    """
+    The encoder of projected model classes. Partial objects lack the columns that weren't loaded, so putting them
+    would overwrite these columns on the server
+    """
+    raise ModelError("Cannot encode a partial %s object loaded with properties %s" %
+                     (obj._table, sorted(obj.__projection__)))
+
+
+def _partialBatchEncoder(objs):
+    """
+    The batch encoder of projected model classes. See _partialEncoder
+    """
+    for obj in objs:
+        _partialEncoder(obj)
+
+    return []
+
+
+def _bindLocals(lines, ns):
+    """
+    Turn the names of ns used by a generated function into default arguments of it, so that the function reads them
+    as fast locals rather than globals
+    :param lines: the function's source lines, starting with its "def name(args):" line
+    :return: the function's source
+    """
+
+    body = '\n'.join(lines[1:])
+    names = [name for name in sorted(ns) if re.search(r'\b%s\b' % name, body)]
+
+    return '\n'.join([lines[0][:-2] + ''.join(', %s=%s' % (name, name) for name in names) + '):'] + lines[1:])
+
+
+def _compileCodecs(cls, projection=None):
+    """
+    Generate decoders and encoders specialized for a model class.
+    Instead of walking the columns dict for every object, the generated functions handle each column in its own
+    unrolled block, with the column codecs bound as locals.
+    The batch versions handle many objects column by column, converting each column's values with the column's
+    decodeMany/encodeMany in one call.
+
+    :param projection: for projected classes, the set of properties to decode. Other columns are skipped, and the
+    encoders refuse to encode objects
+    :return: a (decoder, encoder, batchDecoder, batchEncoder) tuple of static methods. The decoder's signature is
+    decoder(id, properties, strict) and it returns a new object. The encoder's signature is encoder(obj), and it
+    returns an Entity. The batch decoder's signature is batchDecoder(rows, strict) for a list of raw
+    {'id': ..., 'properties': {...}} documents, and the batch encoder's is batchEncoder(objs). They return lists
+    """
+
+    primary = cls.__primary__
+    pcol = cls.__columns__[primary]
+    compact = cls.__compact__
+
+    ns = {
+        '_cls': cls,
+        '_new': object.__new__,
+        '_MISSING': _MISSING,
+        '_Entity': Entity,
+        '_unmapped': _unmapped,
+        '_ColumnValueError': ColumnValueError,
+        '_pdecode': pcol.decode,
+        '_pencode': pcol.encode,
+        '_pdecodeMany': pcol.decodeMany,
+        '_pencodeMany': pcol.encodeMany,
+        '_getattr': getattr,
+        '_izip': itertools.izip,
+        # builtins used by the generated code, bound as locals like the rest
+        'len': len,
+        'sum': sum,
+        'map': map,
+    }
+
+    # compact objects are filled through their slot descriptors, bound as locals too
+    if compact:
+        ns['_pset'] = getattr(cls, _slotName(pcol.modelName)).__set__
+        dec = ['def decoder(id, props, strict=True):',
+               '    obj = _new(_cls)',
+               '    _pset(obj, _pdecode(id))',
+               '    n = 0']
+        enc = ['def encoder(obj):',
+               '    props = {}']
+        bdec = ['def batchDecoder(rows, strict=True):',
+                '    objs = [_new(_cls) for _ in rows]',
+                '    for obj, v in _izip(objs, _pdecodeMany([row["id"] for row in rows])):',
+                '        _pset(obj, v)',
+                '    targets = objs']
+        benc = ['def batchEncoder(objs):',
+                '    sources = objs']
+    else:
+        dec = ['def decoder(id, props, strict=True):',
+               '    obj = _new(_cls)',
+               '    d = obj.__dict__',
+               '    d[%r] = _pdecode(id)' % pcol.modelName,
+               '    n = 0']
+        enc = ['def encoder(obj):',
+               '    d = obj.__dict__',
+               '    props = {}']
+        bdec = ['def batchDecoder(rows, strict=True):',
+                '    objs = [_new(_cls) for _ in rows]',
+                '    targets = [obj.__dict__ for obj in objs]',
+                '    for d, v in _izip(targets, _pdecodeMany([row["id"] for row in rows])):',
+                '        d[%r] = v' % pcol.modelName]
+        benc = ['def batchEncoder(objs):',
+                '    sources = [obj.__dict__ for obj in objs]']
+
+    bdec += ['    allProps = [row["properties"] for row in rows]',
+             '    n = 0']
+
+    # mutable columns are copied as they are decoded, to detect changes made to their values in place. See Model
+    snapshot = cls.__tracking__ and any(projection is None or col.name in projection
+                                        for col in cls.__mutable__.itervalues())
+    if snapshot:
+        ns['_setattr'] = _setattr
+        dec += ['    snap = {}']
+        bdec += ['    snaps = [{} for _ in rows]']
+    benc += ['    allProps = [{} for _ in objs]']
+
+    for i, (k, col) in enumerate(cls.__columns__.iteritems()):
+        if k == primary or (projection is not None and k not in projection):
+            continue
+
+        ns['_dec%d' % i] = col.decode
+        ns['_enc%d' % i] = col.encode
+        ns['_decMany%d' % i] = col.decodeMany
+        ns['_encMany%d' % i] = col.encodeMany
+
+        if compact:
+            ns['_set%d' % i] = getattr(cls, _slotName(col.modelName)).__set__
+            store = '_set%d(obj, v)' % i
+            load = '_getattr(obj, %r, _MISSING)' % _slotName(col.modelName)
+            batchStore = '_set%d(t, v)' % i
+            batchLoad = '[_getattr(obj, %r, _MISSING) for obj in sources]' % _slotName(col.modelName)
+        else:
+            store = 'd[%r] = v' % col.modelName
+            load = 'd.get(%r, _MISSING)' % col.modelName
+            batchStore = 't[%r] = v' % col.modelName
+            batchLoad = '[d.get(%r, _MISSING) for d in sources]' % col.modelName
+
+        # the batch codecs gather a column's values, leaving out the objects where it is missing
+        # (_MISSING in vals would be slow for unicode values, hence the identity checks)
+        bdec += ['    vals = [props.get(%r, _MISSING) for props in allProps]' % k,
+                 '    dst = targets',
+                 '    present = [v for v in vals if v is not _MISSING]',
+                 '    if len(present) != len(vals):',
+                 '        dst = [t for t, v in _izip(targets, vals) if v is not _MISSING]',
+                 '    vals = present',
+                 '    n += len(vals)']
+        if snapshot and col.mutable:
+            ns['_copy%d' % i] = col.copy
+            bdec += ['    dstSnaps = snaps',
+                     '    if dst is not targets:',
+                     '        dstSnaps = [s for s, v in _izip(snaps, allProps) if %r in v]' % k,
+                     '    for t, v, s in _izip(dst, _decMany%d(vals), dstSnaps):' % i,
+                     '        ' + batchStore,
+                     '        s[%r] = _copy%d(v)' % (col.modelName, i)]
+        else:
+            bdec += ['    for t, v in _izip(dst, _decMany%d(vals)):' % i,
+                     '        ' + batchStore]
+
+        benc += ['    vals = ' + batchLoad,
+                 '    dst = allProps',
+                 '    present = [v for v in vals if v is not _MISSING]',
+                 '    if len(present) != len(vals):']
+        if col.required:
+            benc += ['        raise _ColumnValueError("Required column %s not set in %%s" %% _cls._table)' %
+                     col.modelName]
+        else:
+            benc += ['        dst = [p for p, v in _izip(allProps, vals) if v is not _MISSING]']
+        benc += ['    vals = present',
+                 '    for props, v in _izip(dst, _encMany%d(vals)):' % i,
+                 '        props[%r] = v' % k]
+
+        dec += ['    v = props.get(%r, _MISSING)' % k,
+                '    if v is not _MISSING:',
+                '        v = _dec%d(v)' % i,
+                '        ' + store,
+                '        n += 1']
+        if snapshot and col.mutable:
+            dec += ['        snap[%r] = _copy%d(v)' % (col.modelName, i)]
+
+        enc += ['    v = ' + load,
+                '    if v is not _MISSING:',
+                '        props[%r] = _enc%d(v)' % (k, i)]
+        if col.required:
+            enc += ['    else:',
+                    '        raise _ColumnValueError("Required column %s not set in %%s" %% obj._table)' %
+                    col.modelName]
+
+    dec += ['    if n != len(props):',
+            '        _unmapped(_cls, props, strict)']
+    if snapshot:
+        dec += ['    _setattr(obj, "_snapshot", snap)']
+    dec += ['    return obj']
+
+    enc += ['    ent = _Entity(_pencode(_getattr(obj, %r)))' % primary,
+            '    ent.properties = props',
+            '    return ent']
+
+    bdec += ['    if n != sum(map(len, allProps)):',
+             '        for props in allProps:',
+             '            _unmapped(_cls, props, strict)']
+    if snapshot:
+        bdec += ['    for obj, snap in _izip(objs, snaps):',
+                 '        _setattr(obj, "_snapshot", snap)']
+    bdec += ['    return objs']
+
+    benc += ['    ents = [_Entity(v) for v in _pencodeMany([_getattr(obj, %r) for obj in objs])]' % primary,
+             '    for ent, props in _izip(ents, allProps):',
+             '        ent.properties = props',
+             '    return ents']
+
+    src = '\n'.join(_bindLocals(lines, ns) for lines in (dec, enc, bdec, benc)) + '\n'
+    exec compile(src, '<meduza codecs for %s>' % cls.__name__, 'exec') in ns
+
+    if projection is not None:
+        return (staticmethod(ns['decoder']), staticmethod(_partialEncoder),
+                staticmethod(ns['batchDecoder']), staticmethod(_partialBatchEncoder))
+
+    return (staticmethod(ns['decoder']), staticmethod(ns['encoder']),
+            staticmethod(ns['batchDecoder']), staticmethod(ns['batchEncoder']))
 
 
 class Model(object):
@@ -49,14 +374,39 @@ class Model(object):
     _table = None
     _schema = None
     __columns__ = None
+    # specialized codec functions generated by ModelType
+    __decoder__ = None
+    __encoder__ = None
+    __batchDecoder__ = None
+    __batchEncoder__ = None
+    # the properties loaded into objects of projected classes, None for full objects. See projected()
+    __projection__ = None
+    __projections__ = None
+    # store columns in __slots__ instead of __dict__. See ModelType
+    __compact__ = False
+    # column attribute name => column, for the columns whose changes are tracked (all but the primary key)
+    __tracked__ = None
+    # the tracked columns whose values can be changed in place (see Column.mutable)
+    __mutable__ = None
+    # track assignments to columns. See ModelType
+    __tracking__ = True
+    # _dirty holds the names of the column attributes assigned since the object was loaded or saved. Decoded objects
+    # don't have it set, which means they are clean. _snapshot holds copies of the mutable columns' values as they
+    # were loaded or saved, to find the ones changed in place. _unsaved is set on objects created by the constructor
+    # until they are put. Compact subclasses need all their bases to have slots
+    __slots__ = ('_dirty', '_snapshot', '_unsaved')
 
     id = Key(ID)
 
     def __init__(self, **kwargs):
-        self.__dict__.update(kwargs)
+        if self.__compact__:
+            for k, v in kwargs.iteritems():
+                _setattr(self, k, v)
+        else:
+            self.__dict__.update(kwargs)
 
         # If the object doesn't have a primary value, put none
-        if self.__primary__ not in self.__dict__:
+        if not self._isSet(self.__columns__[self.__primary__].modelName):
             self.setPrimary(None)
 
         primary = self.__primary__
@@ -64,19 +414,158 @@ class Model(object):
         for k, col in self.__columns__.iteritems():
             if k == primary:
                 continue
-            if col.modelName not in self.__dict__:
+            if not self._isSet(col.modelName):
                 default = col.default()
                 if default is not Column.Undefined:
-                    setattr(self, col.modelName, default)
+                    _setattr(self, col.modelName, default)
 
-    def __getattribute__(self, item):
-        ret = object.__getattribute__(self, item)
+        # new objects are dirty in all their set columns
+        self.markDirty(*(attr for attr in self.__tracked__ if self._isSet(attr)))
+        _setattr(self, '_unsaved', True)
+
+    def __setattr__(self, name, value, _setattr=_setattr):
+        """
+        Track assignments to columns. This makes every attribute assignment a python function call, about 10 times
+        slower than a plain assignment. Hot loops assigning to many objects should pass the values to the constructor,
+        or use a model with __tracking__ = False
+        """
+        _setattr(self, name, value)
+
+        if name in self.__tracked__:
+            try:
+                self._dirty.add(name)
+            except AttributeError:
+                _setattr(self, '_dirty', {name})
+
+    def __getstate__(self):
+        # python 2 can't pickle objects with __slots__ without this
+        return (self._attributes(), getattr(self, '_dirty', None), getattr(self, '_unsaved', False),
+                getattr(self, '_snapshot', None))
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # pickled before changes were tracked, as a plain __dict__. We don't know what changed, so all the set
+            # columns are dirty, and objects without an id were never put
+            attributes = state
+            dirty = {attr for attr in self.__tracked__ if attr in state}
+            unsaved = state.get(self.__columns__[self.__primary__].modelName) is None
+        else:
+            attributes, dirty, unsaved, snapshot = (state + (False, None))[:4]
+            if snapshot is not None:
+                _setattr(self, '_snapshot', snapshot)
+
+        for k, v in attributes.iteritems():
+            _setattr(self, k, v)
+        if dirty is not None:
+            _setattr(self, '_dirty', dirty)
+        if unsaved:
+            _setattr(self, '_unsaved', True)
+
+    def isDirty(self):
+        """
+        Check whether any column of the object was changed since it was loaded or saved
+        """
+        return bool(self._changed())
+
+    def dirtyColumns(self):
+        """
+        Get the attribute names of the columns changed since the object was loaded or saved.
+        Columns are changed by assigning to them, or for mutable columns (sets, lists, maps and binaries) by changing
+        their values in place, which we find by comparing the values to copies taken when the object was loaded or saved
+        :return: a set of attribute names
+        """
+        return set(self._changed())
+
+    def markDirty(self, *names):
+        """
+        Mark column attributes as changed, so they are sent by the next save
+        """
+        for name in names:
+            if name not in self.__tracked__:
+                raise ModelError("%s is not a column of %s" % (name, self.__class__.__name__))
+
+        dirty = getattr(self, '_dirty', None)
+        if dirty is None:
+            _setattr(self, '_dirty', set(names))
+        else:
+            dirty.update(names)
+
+    def markClean(self):
+        """
+        Forget the changes of the object, after they were saved
+        """
+        if getattr(self, '_dirty', None):
+            _setattr(self, '_dirty', set())
+
+        if self.__mutable__ and self.__tracking__:
+            _setattr(self, '_snapshot', {attr: col.copy(getattr(self, attr))
+                                         for attr, col in self.__mutable__.iteritems() if self._isSet(attr)})
+
+    def isSaved(self):
+        """
+        Check whether the object was loaded from the server or put to it, as opposed to created and not put yet
+        """
+        return not getattr(self, '_unsaved', False)
+
+    def markSaved(self):
+        """
+        Mark the object as stored by the server with all its changes, after it was put
+        """
+        if getattr(self, '_unsaved', False):
+            del self._unsaved
+        self.markClean()
+
+    def changes(self):
+        """
+        Get the changes of the object since it was loaded or saved, as SET changes of the changed columns
+        :return: a list of Change objects, empty if the object is clean
+        """
+
+        ret = []
+        for name in self._changed():
+            col = self.__tracked__[name]
+            ret.append(Change.set(col.name, col.encode(getattr(self, name))))
 
-        #each column has a default zero-value, for most it's None
-        if isinstance(ret, Column):
-            return ret.zero
         return ret
 
+    def _changed(self):
+        """
+        Get the attribute names of the columns assigned to, and of the mutable columns changed in place
+        :return: a set or a tuple of attribute names
+        """
+
+        dirty = getattr(self, '_dirty', None) or ()
+        if not self.__mutable__ or not self.__tracking__:
+            return dirty
+
+        snapshot = getattr(self, '_snapshot', None) or {}
+        changed = [attr for attr in self.__mutable__
+                   if attr not in dirty and self._isSet(attr) and snapshot.get(attr, _MISSING) != getattr(self, attr)]
+
+        if not changed:
+            return dirty
+
+        return set(dirty).union(changed)
+
+    def _isSet(self, attr):
+        """
+        Check whether a column attribute is set on the object, as opposed to reading as the column's zero value
+        """
+        if self.__compact__:
+            return hasattr(self, _slotName(attr))
+
+        return attr in self.__dict__
+
+    def _attributes(self):
+        """
+        Get the attributes set on the object as a dict
+        """
+        if self.__compact__:
+            return {col.modelName: getattr(self, _slotName(col.modelName))
+                    for col in self.__columns__.itervalues() if hasattr(self, _slotName(col.modelName))}
+
+        return dict(self.__dict__)
+
     @classmethod
     def all(cls):
         return Filter(cls.__primary__, Condition.ALL)
@@ -90,32 +579,42 @@ class Model(object):
         return cls.__primary__
 
     @classmethod
-    def decode(cls, entity, strict=True):
+    def projected(cls, properties):
         """
-        Decode an entity into the model's class using the column spec
-        :param entity: an entity
-        :param strict: strict decoding mode - altering of object fields not in the model's schema
-        :return:
+        Get the subclass of the model for partial objects loaded with only some of their properties.
+        Its decoder only decodes these properties, leaving the other columns unset, and its objects can't be encoded
+        for putting. Projected classes are created once per set of properties
+        :param properties: the (server side) names of the loaded properties
+        :return: the projected model class, or the model itself if properties is empty
         """
-        cols = cls.__columns__
 
-        obj = object.__new__(cls)
-        obj.setPrimary(entity.id)
+        if not properties:
+            return cls
 
-        for k, v in entity.properties.iteritems():
+        if cls.__projection__ is not None:
+            raise ModelError("%s is already projected" % cls.__name__)
 
-            if k == cls.__primary__:
-                continue
+        key = frozenset(properties)
+        projected = cls.__projections__.get(key)
+        if projected is None:
+            projected = cls.__projections__[key] = type(cls)(cls.__name__, (cls,), {
+                '__projection__': key,
+                '__module__': cls.__module__,
+                '__reduce_ex__': _reduceProjected,
+            })
 
-            col = cols.get(k)
-            if not col:
-                if strict:
-                    logging.warn("Could not map %s to object - not in model", k)
-                continue
+        return projected
 
-            setattr(obj, col.modelName, col.decode(v))
+    @classmethod
+    def decode(cls, entity, strict=True):
+        """
+        Decode an entity into the model's class using the column spec
+        :param entity: an entity
+        :param strict: strict decoding mode - altering of object fields not in the model's schema
+        :return:
+        """
 
-        return obj
+        return cls.__decoder__(entity.id, entity.properties, strict)
 
     def encode(self):
         """
@@ -123,29 +622,7 @@ class Model(object):
         :return:
         """
 
-        cols = self.__columns__
-        primary = self.__primary__
-        pcol = cols[primary]
-
-        ent = Entity(pcol.encode(getattr(self, primary)))
-
-        for k, col in cols.iteritems():
-
-            if k == primary:
-                continue
-
-            if col.modelName not in self.__dict__:
-                if col.required:
-                    raise ColumnValueError("Required column %s not set in %s" % (col.modelName, self._table))
-                else:
-                    continue
-
-            data = self.__dict__.get(col.modelName)
-            # print k, data
-            # col.validateChoices(data)
-            ent.properties[k] = col.encode(data)
-
-        return ent
+        return self.__encoder__(self)
 
     @classmethod
     def tableName(cls):
@@ -157,7 +634,7 @@ class Model(object):
         return '%s.%s' % (cls._schema, cls._table)
 
     def __repr__(self):
-        return '%s<%s> %s' % (self._table, getattr(self, self.__primary__), self.__dict__)
+        return '%s<%s> %s' % (self._table, getattr(self, self.__primary__), self._attributes())
 
     def setPrimary(self, val):
         """
@@ -0,0 +1,238 @@
+__author__ = 'dvirsky'
+
+import collections
+import os
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+from .errors import PoolExhaustedError
+
+
+DEFAULT_MAX_SIZE = 16
+DEFAULT_IDLE_TIMEOUT = 60.0
+DEFAULT_WAIT_TIMEOUT = 1.0
+
+
+class ConnectionPool(object):
+    """
+    A bounded pool of reusable connections.
+
+    Connections are created on demand by a factory callable, up to maxSize connections that are either idle in the
+    pool or checked out by callers. When the pool is saturated, callers block until a connection is released, or until
+    waitTimeout seconds have passed, in which case we raise a PoolExhaustedError.
+    Connections that have been idle for more than idleTimeout seconds are closed and dropped from the pool.
+
+    The pool is thread safe and fork aware: a forked child process starts with an empty pool, leaving the connections
+    inherited from the parent to it. Connections created by the factory must have a close() method.
+    """
+
+    def __init__(self, factory, maxSize=DEFAULT_MAX_SIZE, idleTimeout=DEFAULT_IDLE_TIMEOUT,
+                 waitTimeout=DEFAULT_WAIT_TIMEOUT):
+        """
+        :param factory: a callable returning a new connection
+        :param maxSize: the maximal number of connections, idle or in use, the pool may hold
+        :param idleTimeout: seconds after which an idle connection is closed. None or 0 to keep connections forever
+        :param waitTimeout: seconds to wait for a free connection when the pool is saturated. None to wait forever
+        """
+        if maxSize <= 0:
+            raise ValueError("Invalid pool size: %s" % maxSize)
+
+        self._factory = factory
+        self.maxSize = maxSize
+        self.idleTimeout = idleTimeout
+        self.waitTimeout = waitTimeout
+
+        self._pid = os.getpid()
+        self._cond = threading.Condition(threading.Lock())
+        # idle connections and the time they were released, most recently used last
+        self._idle = collections.deque()
+        self._inUse = 0
+
+        self._created = 0
+        self._closed = 0
+        self._acquired = 0
+        self._waits = 0
+        self._timeouts = 0
+        self._waitTime = 0.0
+        self._maxWaitTime = 0.0
+
+    def acquire(self):
+        """
+        Take a connection from the pool, creating a new one if no idle connection is available and the pool is not
+        saturated.
+        :return: a connection. It must be given back with release() or discard()
+        """
+
+        self._checkPid()
+
+        expired = []
+        create = False
+        with self._cond:
+            self._reap(expired)
+
+            if not self._idle and self._inUse >= self.maxSize:
+                self._waits += 1
+                st = time.time()
+                deadline = st + self.waitTimeout if self.waitTimeout is not None else None
+
+                while not self._idle and self._inUse >= self.maxSize:
+                    if deadline is None:
+                        self._cond.wait()
+                        continue
+
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        self._recordWait(time.time() - st)
+                        raise PoolExhaustedError("No free connection after %.03fs (pool size %d)" %
+                                                 (self.waitTimeout, self.maxSize))
+                    self._cond.wait(remaining)
+
+                self._recordWait(time.time() - st)
+
+            if self._idle:
+                conn, _ = self._idle.pop()
+            else:
+                conn = None
+                create = True
+
+            self._inUse += 1
+            self._acquired += 1
+
+        for c in expired:
+            self._close(c)
+
+        if create:
+            try:
+                conn = self._factory()
+            except Exception:
+                with self._cond:
+                    self._inUse -= 1
+                    self._cond.notify()
+                raise
+
+            with self._cond:
+                self._created += 1
+
+        return conn
+
+    def release(self, conn):
+        """
+        Return a healthy connection to the pool for reuse
+        """
+        if self._checkPid():
+            # checked out before a fork, so it belongs to the parent process
+            return
+
+        with self._cond:
+            self._inUse -= 1
+            self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    def discard(self, conn):
+        """
+        Close a connection that is no longer usable (e.g. after a network error) instead of returning it to the pool
+        """
+        if self._checkPid():
+            return
+
+        with self._cond:
+            self._inUse -= 1
+            self._cond.notify()
+
+        self._close(conn)
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection for the duration of a with block. If the block raises an exception the connection's state
+        is unknown, so it is discarded rather than returned to the pool
+        """
+
+        conn = self.acquire()
+        try:
+            yield conn
+        except:
+            self.discard(conn)
+            raise
+        else:
+            self.release(conn)
+
+    def clear(self):
+        """
+        Close all idle connections in the pool. Connections currently in use are not affected
+        """
+        self._checkPid()
+
+        with self._cond:
+            idle = [c for c, _ in self._idle]
+            self._idle.clear()
+
+        for c in idle:
+            self._close(c)
+
+    def stats(self):
+        """
+        Get the pool's usage counters.
+        :return: a dict with the pool size, usage, saturation (in use connections out of maxSize), and the number of
+        and time spent by callers waiting for a free connection
+        """
+        with self._cond:
+            return {
+                'maxSize': self.maxSize,
+                'size': self._inUse + len(self._idle),
+                'inUse': self._inUse,
+                'idle': len(self._idle),
+                'saturation': float(self._inUse) / self.maxSize,
+                'created': self._created,
+                'closed': self._closed,
+                'acquired': self._acquired,
+                'waits': self._waits,
+                'timeouts': self._timeouts,
+                'waitTime': self._waitTime,
+                'maxWaitTime': self._maxWaitTime,
+            }
+
+    def _checkPid(self):
+        """
+        Reset the pool if we are in a process forked since it was last used. The connections and lock inherited from
+        the parent are dropped without closing them, as closing a socket could shut down the parent's connection
+        :return: True if the pool was reset
+        """
+        if self._pid == os.getpid():
+            return False
+
+        self._pid = os.getpid()
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = collections.deque()
+        self._inUse = 0
+        return True
+
+    def _reap(self, expired):
+        """
+        Move connections idle for longer than idleTimeout from the pool to the expired list. Called with the lock held
+        """
+        if not self.idleTimeout:
+            return
+
+        cutoff = time.time() - self.idleTimeout
+        while self._idle and self._idle[0][1] < cutoff:
+            expired.append(self._idle.popleft()[0])
+
+    def _recordWait(self, duration):
+
+        self._waitTime += duration
+        if duration > self._maxWaitTime:
+            self._maxWaitTime = duration
+
+    def _close(self, conn):
+
+        try:
+            conn.close()
+        except Exception:
+            logging.exception("Error closing pooled connection")
+
+        with self._cond:
+            self._closed += 1
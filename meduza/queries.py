@@ -12,6 +12,9 @@ without knowing what you're doing and modifying the server code accordingly.
 import time
 import datetime
 
+from .errors import MeduzaError
+from .columnar import decodeColumns
+
 
 class Condition(object):
     """
@@ -187,26 +190,131 @@ class GetResponse(Response):
     def __init__(self, **kwargs):
         Response.__init__(self, **kwargs['Response'])
 
-        self.entities = [Entity(e['id'], **e['properties']) for e in kwargs.get('entities', [])]
+        # The entity documents as decoded from BSON. load() decodes them straight into model objects and then
+        # releases them, so we don't keep a copy of the result set around
+        self._rows = kwargs.get('entities') or []
+        self._entities = None
         self.total = kwargs.get('total', 0)
 
+    @property
+    def entities(self):
+        """
+        The selected entities as Entity objects. Only built on demand, objects loaded with load() don't need them
+        """
+        if self._entities is None:
+            self._entities = [Entity(e['id'], **e['properties']) for e in self.rows()]
+
+        return self._entities
+
+    def rows(self):
+        """
+        The raw entity documents of the response, as {'id': ..., 'properties': {...}} dicts
+        """
+
+        if self._rows is None:
+            raise MeduzaError("Response entities have already been loaded and released")
+
+        return self._rows
+
+    def load(self, model, release=True):
+        """
+        Decode the selected entities into model objects
+        :param model: the model class to create objects of
+        :param release: if True, drop the raw entity documents once they are decoded, so they can be freed.
+        The response can't be loaded again after that
+        :return: a list of model objects
+        """
+
+        ret = model.__batchDecoder__(self.rows())
 
-    def load(self, model):
+        if release:
+            self._rows = None
 
+        return ret
 
-        ret = []
-        for e in self.entities:
+    def loadLazy(self, model):
+        """
+        Wrap the selected entities in a LazyResult, decoding each into a model object only when it is accessed.
+        The response releases the raw entity documents to the result, so it can't be loaded again
+        :param model: the model class to create objects of
+        :return: a LazyResult
+        """
 
-            ret.append(model.decode(e))
+        ret = LazyResult(model, self.rows(), self.total)
+        self._rows = None
+
+        return ret
+
+    def loadColumns(self, model, properties=None, release=True):
+        """
+        Decode the selected entities into one array per column instead of model objects. See meduza.columnar
+        :param model: the model class whose columns are decoded
+        :param properties: if set, only decode these properties
+        :param release: if True, drop the raw entity documents once they are decoded
+        :return: a dict of column attribute name => array or list
+        """
+
+        ret = decodeColumns(model, self.rows(), properties)
+
+        if release:
+            self._rows = None
 
         return ret
 
     def loadOne(self, model):
 
-        if len(self.entities) == 0:
+        rows = self.rows()
+        if len(rows) == 0:
             return None
 
-        return model.decode(self.entities[0])
+        return model.__decoder__(rows[0]['id'], rows[0]['properties'])
+
+
+_UNDECODED = object()
+
+
+class LazyResult(object):
+    """
+    A read-only sequence of model objects that are decoded from their raw entity documents only when they are indexed or
+    iterated. Decoded objects are kept, and their raw documents released.
+    This saves CPU and memory when only some of the rows of a large result set are used
+    """
+
+    def __init__(self, model, rows, total=0):
+
+        self._decode = model.__decoder__
+        self._rows = rows
+        self._objs = [_UNDECODED] * len(rows)
+        self.total = total
+
+    def __len__(self):
+        return len(self._objs)
+
+    def _get(self, i):
+
+        obj = self._objs[i]
+        if obj is _UNDECODED:
+            row = self._rows[i]
+            obj = self._objs[i] = self._decode(row['id'], row['properties'])
+            self._rows[i] = None
+
+        return obj
+
+    def __getitem__(self, item):
+
+        if isinstance(item, slice):
+            return [self._get(i) for i in xrange(*item.indices(len(self._objs)))]
+
+        return self._get(item)
+
+    def __iter__(self):
+
+        for i in xrange(len(self._objs)):
+            yield self._get(i)
+
+    def __repr__(self):
+
+        return 'LazyResult<%d of %d>' % (len(self._objs), self.total)
 
 
 class PutQuery(object):
@@ -0,0 +1,270 @@
+"""
+Read routing across multiple meduza replicas.
+
+A ReplicaConnector is a connector (see meduza.customConnector) that spreads the requests of a session over a list of
+replica servers, each with its own connection pool. Replicas are chosen by one of these policies:
+
+    * ROUND_ROBIN - take turns
+    * LEAST_OUTSTANDING - the replica with the fewest requests in flight from this process
+    * EWMA - the replica with the lowest exponentially weighted moving average of request latency, weighted by its
+      requests in flight
+
+A background thread pings the replicas periodically, each on a connection of its own rather than one from the replica's
+pool, so that a busy replica is not mistaken for a failed one. Replicas failing a ping, or raising a connection error
+on a request, are taken out of rotation until a ping to them succeeds again.
+
+Usage:
+>> replicas = ReplicaConnector([('replica1', 9977), ('replica2', 9977)], policy=EWMA)
+>> meduza.setup(meduza.customConnector('master', 9977), replicas)
+"""
+import itertools
+import logging
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+import redis
+
+from .client import RedisClient, RedisTransport, getPool, warmPool
+from .pool import DEFAULT_MAX_SIZE, DEFAULT_IDLE_TIMEOUT, DEFAULT_WAIT_TIMEOUT
+from .queries import PingQuery
+
+__author__ = 'dvirsky'
+
+
+ROUND_ROBIN = 'roundRobin'
+LEAST_OUTSTANDING = 'leastOutstanding'
+EWMA = 'ewma'
+
+DEFAULT_HEALTH_CHECK_INTERVAL = 1.0
+# the weight of the newest sample in the latency moving average
+DEFAULT_EWMA_DECAY = 0.3
+
+# errors meaning the replica itself is unreachable, as opposed to a bad request
+_CONNECTION_ERRORS = (redis.ConnectionError, redis.TimeoutError, socket.error)
+
+
+class Replica(object):
+    """
+    A single replica endpoint, with its connection pool and routing state
+    """
+
+    def __init__(self, host, port, pool):
+
+        self.host = host
+        self.port = port
+        self.pool = pool
+
+        self.healthy = True
+        self.outstanding = 0
+        # None until the first request completes
+        self.latency = None
+        self.requests = 0
+        self.failures = 0
+        self.lastError = None
+        # the connection used for health check pings, outside the pool
+        self.healthTransport = None
+
+    def __repr__(self):
+        return 'Replica(%s:%s, healthy=%s)' % (self.host, self.port, self.healthy)
+
+    def stats(self):
+
+        return {
+            'healthy': self.healthy,
+            'outstanding': self.outstanding,
+            'latency': self.latency,
+            'requests': self.requests,
+            'failures': self.failures,
+            'lastError': self.lastError,
+        }
+
+
+class ReplicaConnector(object):
+    """
+    A connector yielding clients connected to one of several replicas. Use it as a session's slaveConnector.
+    It is thread safe, and can be shared by sessions
+    """
+
+    def __init__(self, endpoints, policy=ROUND_ROBIN, timeout=0.5, poolSize=DEFAULT_MAX_SIZE,
+                 idleTimeout=DEFAULT_IDLE_TIMEOUT, waitTimeout=DEFAULT_WAIT_TIMEOUT,
+                 healthCheckInterval=DEFAULT_HEALTH_CHECK_INTERVAL, ewmaDecay=DEFAULT_EWMA_DECAY):
+        """
+        :param endpoints: a list of (host, port) tuples of the replicas
+        :param policy: ROUND_ROBIN, LEAST_OUTSTANDING or EWMA
+        :param poolSize: the maximal number of connections to each replica
+        :param healthCheckInterval: seconds between background pings of the replicas. None or 0 to disable the
+        background checks, in which case checkHealth() can be called explicitly
+        :param ewmaDecay: the weight, between 0 and 1, of the newest latency sample in a replica's moving average
+        """
+
+        if not endpoints:
+            raise ValueError("No replica endpoints given")
+        if policy not in (ROUND_ROBIN, LEAST_OUTSTANDING, EWMA):
+            raise ValueError("Invalid routing policy: %s" % policy)
+
+        self.policy = policy
+        self.ewmaDecay = ewmaDecay
+        self.timeout = timeout
+        self.replicas = [Replica(host, port, getPool(host, port, timeout, maxSize=poolSize, idleTimeout=idleTimeout,
+                                                     waitTimeout=waitTimeout))
+                         for host, port in endpoints]
+
+        self._lock = threading.Lock()
+        self._healthLock = threading.Lock()
+        self._turns = itertools.count()
+
+        self._stopped = threading.Event()
+        self._thread = None
+        if healthCheckInterval:
+            self._thread = threading.Thread(target=self._healthLoop, args=(healthCheckInterval,),
+                                            name='meduza-replica-health')
+            self._thread.daemon = True
+            self._thread.start()
+
+    @contextmanager
+    def __call__(self):
+
+        replica = self.choose()
+
+        with self._lock:
+            replica.outstanding += 1
+            replica.requests += 1
+
+        st = time.time()
+        try:
+            with replica.pool.connection() as transport:
+                yield RedisClient(transport=transport)
+        except _CONNECTION_ERRORS as e:
+            self._markFailed(replica, e)
+            raise
+        finally:
+            with self._lock:
+                replica.outstanding -= 1
+
+        self._recordLatency(replica, time.time() - st)
+
+    def choose(self):
+        """
+        Choose the replica for the next request according to the routing policy.
+        If all the replicas are unhealthy, we choose among all of them rather than fail the request
+        :return: a Replica object
+        """
+
+        candidates = [r for r in self.replicas if r.healthy] or self.replicas
+
+        # rotating the candidates makes min() break ties in turns too
+        turn = next(self._turns) % len(candidates)
+        if self.policy == ROUND_ROBIN:
+            return candidates[turn]
+
+        candidates = candidates[turn:] + candidates[:turn]
+        if self.policy == LEAST_OUTSTANDING:
+            return min(candidates, key=lambda r: r.outstanding)
+
+        # replicas without a latency sample yet are tried first, so that all of them get measured
+        return min(candidates, key=lambda r: (r.latency or 0.0) * (r.outstanding + 1))
+
+    def checkHealth(self):
+        """
+        Ping all the replicas, taking failing ones out of rotation and returning recovered ones to it
+        """
+
+        with self._healthLock:
+            for replica in self.replicas:
+                try:
+                    self._ping(replica)
+                except _CONNECTION_ERRORS as e:
+                    self._markFailed(replica, e)
+                except Exception:
+                    logging.exception("Error pinging replica %s:%s", replica.host, replica.port)
+                else:
+                    if not replica.healthy:
+                        logging.info("Replica %s:%s is back in rotation", replica.host, replica.port)
+                    replica.healthy = True
+
+    def _ping(self, replica):
+        """
+        Ping a replica on its health check connection, raising a connection error if the ping fails
+        """
+
+        if replica.healthTransport is None:
+            replica.healthTransport = RedisTransport(replica.host, replica.port, self.timeout)
+
+        try:
+            res = RedisClient(transport=replica.healthTransport).do(PingQuery())
+        except redis.ResponseError as e:
+            # an error reply to a ping
+            raise redis.ConnectionError(str(e))
+        except _CONNECTION_ERRORS:
+            replica.healthTransport.close()
+            replica.healthTransport = None
+            raise
+
+        if res.error is not None:
+            raise redis.ConnectionError(res.error)
+
+    def warmup(self, connections):
+        """
+        Open connections to every healthy replica ahead of the first requests
+        :param connections: the number of connections to open per replica
+        """
+        for replica in self.replicas:
+            if replica.healthy:
+                try:
+                    warmPool(replica.pool, connections)
+                except _CONNECTION_ERRORS as e:
+                    self._markFailed(replica, e)
+
+    def close(self):
+        """
+        Stop the background health checks and close their connections
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        with self._healthLock:
+            for replica in self.replicas:
+                if replica.healthTransport is not None:
+                    replica.healthTransport.close()
+                    replica.healthTransport = None
+
+    def stats(self):
+        """
+        Get the routing state of the replicas
+        :return: a dict of "host:port" => replica stats dict
+        """
+        with self._lock:
+            return {'%s:%s' % (r.host, r.port): r.stats() for r in self.replicas}
+
+    def _markFailed(self, replica, err):
+
+        with self._lock:
+            replica.failures += 1
+            replica.lastError = str(err)
+            wasHealthy, replica.healthy = replica.healthy, False
+
+        if wasHealthy:
+            logging.warning("Taking replica %s:%s out of rotation: %s", replica.host, replica.port, err)
+
+        # connections to a failed replica are likely broken too
+        replica.pool.clear()
+
+    def _recordLatency(self, replica, duration):
+
+        with self._lock:
+            if replica.latency is None:
+                replica.latency = duration
+            else:
+                replica.latency += self.ewmaDecay * (duration - replica.latency)
+
+    def _healthLoop(self, interval):
+
+        while not self._stopped.wait(interval):
+            try:
+                self.checkHealth()
+            except Exception:
+                logging.exception("Error checking replicas health")
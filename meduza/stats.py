@@ -0,0 +1,191 @@
+"""
+Latency histograms for meduza queries.
+
+Clients record, per message type and table, how long each phase of a query took:
+
+    * serialize - encoding the query into a BSON message
+    * network - sending the message and waiting for the response
+    * deserialize - decoding the response message
+    * decode - decoding the returned entities into model objects
+    * server - the processing time reported by the server
+
+Comparing them tells whether a slow query waits on the server, on the wire, or on client side encoding and decoding.
+
+Usage:
+>> meduza.stats.snapshot()
+{'GET': {'pytest.Users': {'network': {'count': 10, 'mean': 0.0004, 'p99': 0.001, ...}, ...}}}
+"""
+import bisect
+import threading
+
+__author__ = 'dvirsky'
+
+
+SERIALIZE = 'serialize'
+NETWORK = 'network'
+DESERIALIZE = 'deserialize'
+DECODE = 'decode'
+SERVER = 'server'
+
+# bucket upper bounds in seconds, from 1us doubling up to ~2 minutes
+BUCKETS = tuple(1e-6 * 2 ** i for i in xrange(28))
+
+
+class Histogram(object):
+    """
+    A thread safe histogram of durations in seconds, with exponential buckets
+    """
+
+    def __init__(self, buckets=BUCKETS):
+
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+
+        with self._lock:
+            # the last count is for values above the largest bucket
+            self._counts = [0] * (len(self.buckets) + 1)
+            self.count = 0
+            self.sum = 0.0
+            self.min = None
+            self.max = None
+
+    def record(self, value):
+
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self.count += 1
+            self.sum += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def percentile(self, p):
+        """
+        Estimate a percentile of the recorded values
+        :param p: the percentile, between 0 and 100
+        :return: the upper bound of the bucket holding the percentile, capped by the maximal value. None if empty
+        """
+        with self._lock:
+            return self._percentile(p)
+
+    def _percentile(self, p):
+
+        if not self.count:
+            return None
+
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self._counts):
+            seen += n
+            if seen >= rank and n:
+                return min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+
+        return self.max
+
+    def snapshot(self):
+        """
+        :return: a dict with the count, sum, mean, min, max and 50/90/99 percentiles of the recorded values
+        """
+        with self._lock:
+            return {
+                'count': self.count,
+                'sum': self.sum,
+                'mean': self.sum / self.count if self.count else None,
+                'min': self.min,
+                'max': self.max,
+                'p50': self._percentile(50),
+                'p90': self._percentile(90),
+                'p99': self._percentile(99),
+            }
+
+
+enabled = True
+
+_histograms = {}
+_lock = threading.Lock()
+
+
+def enable():
+    """
+    Start recording query stats. Stats are enabled by default
+    """
+    global enabled
+    enabled = True
+
+
+def disable():
+    """
+    Stop recording query stats
+    """
+    global enabled
+    enabled = False
+
+
+def histogram(msgType, table, phase):
+    """
+    Get the histogram of a query phase, creating it if needed
+    """
+    key = (msgType, table, phase)
+
+    h = _histograms.get(key)
+    if h is None:
+        with _lock:
+            h = _histograms.setdefault(key, Histogram())
+
+    return h
+
+
+def record(msgType, table, phase, seconds):
+    """
+    Record the duration of a query phase
+    :param msgType: the query's message type (e.g. Message.GET)
+    :param table: the query's table name
+    :param phase: one of SERIALIZE, NETWORK, DESERIALIZE, DECODE or SERVER
+    :param seconds: the duration in seconds
+    """
+    if enabled:
+        histogram(msgType, table, phase).record(seconds)
+
+
+def recordQuery(msgType, table, serialize, network, deserialize, serverTime):
+    """
+    Record the client side phases of a query round trip, and the server processing time from its response
+    :param serverTime: the server reported processing time in nanoseconds, or None
+    """
+    if not enabled:
+        return
+
+    histogram(msgType, table, SERIALIZE).record(serialize)
+    histogram(msgType, table, NETWORK).record(network)
+    histogram(msgType, table, DESERIALIZE).record(deserialize)
+    if serverTime is not None:
+        histogram(msgType, table, SERVER).record(serverTime / 1e9)
+
+
+def snapshot(msgType=None, table=None):
+    """
+    Get the recorded stats, optionally only of one message type and/or table
+    :return: a nested dict of message type => table => phase => histogram snapshot
+    """
+    with _lock:
+        items = _histograms.items()
+
+    ret = {}
+    for (t, tbl, phase), h in items:
+        if (msgType is None or t == msgType) and (table is None or tbl == table):
+            ret.setdefault(t, {}).setdefault(tbl, {})[phase] = h.snapshot()
+
+    return ret
+
+
+def reset():
+    """
+    Clear all the recorded stats
+    """
+    with _lock:
+        _histograms.clear()
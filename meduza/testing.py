@@ -1,13 +1,24 @@
 from __future__ import absolute_import
+import itertools
+import logging
+import random
 import shutil
 import socket
+import SocketServer
 import subprocess
 import tempfile
+import threading
 import time
 import os
+import bson
 import requests
 import yaml
 
+from .client import Message, packCommand
+from .columns import NIL
+from .model import ID
+from .queries import Condition, Change, Entity, nanoseconds
+
 __author__ = 'bergundy'
 
 
@@ -94,3 +105,319 @@ def installSchema(schema, port=9966):
 
     if res.status_code != 200 or res.content != 'OK':
         raise RuntimeError('Failed to install schema')
+
+
+class MemoryStore(object):
+    """
+    The in-memory tables of an InMemoryMeduza server, executing decoded query documents.
+    Tables are schemaless and created on first use. Entities are kept as {id: (properties, expiration time)}
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tables = {}
+        self._seq = itertools.count(1)
+
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
+
+    def newId(self):
+        # ids sort in insertion order, like the server's generated ids
+        return '%016x' % next(self._seq)
+
+    def _table(self, name):
+        return self._tables.setdefault(name, {})
+
+    def _live(self, table, id, now):
+        """
+        Get a live entity's properties, expiring it if its TTL has passed
+        """
+        ent = table.get(id)
+        if ent is None:
+            return None
+
+        props, expires = ent
+        if expires is not None and expires <= now:
+            del table[id]
+            return None
+
+        return props
+
+    @staticmethod
+    def _match(id, props, filters):
+
+        for flt in filters:
+            op = flt['op']
+            if op == Condition.ALL:
+                continue
+
+            prop = flt['property']
+            value = id if prop in (ID, Entity.ID) else props.get(prop)
+            values = flt['values']
+
+            if op == Condition.EQ:
+                # missing properties are the empty value
+                if value != values[0] and not (value is None and values[0] == ''):
+                    return False
+            elif op == Condition.IN:
+                if value not in values:
+                    return False
+            elif op == Condition.GT:
+                if value is None or not value > values[0]:
+                    return False
+            elif op == Condition.LT:
+                if value is None or not value < values[0]:
+                    return False
+            else:
+                raise ValueError("Unsupported filter condition %s" % op)
+
+        return True
+
+    def _select(self, table, filters):
+        """
+        Find the entities matching a query's filters dict
+        :return: a list of (id, properties) tuples, ordered by id unless the query selects by a list of ids, in which
+        case we keep the order of that list
+        """
+        # GetQuery.all() sets a bare ALL condition instead of a filter
+        filters = [f for f in filters.itervalues() if isinstance(f, dict)]
+
+        now = time.time()
+        byId = [f for f in filters if f['property'] in (ID, Entity.ID) and f['op'] in (Condition.IN, Condition.EQ)]
+        if byId:
+            ids = []
+            for id in byId[0]['values']:
+                if id not in ids:
+                    ids.append(id)
+        else:
+            ids = sorted(table)
+
+        ret = []
+        for id in ids:
+            props = self._live(table, id, now)
+            if props is not None and self._match(id, props, filters):
+                ret.append((id, props))
+
+        return ret
+
+    def get(self, q):
+
+        # the stored properties are changed in place by updates, so we copy them before releasing the lock
+        with self._lock:
+            rows = [(id, dict(props)) for id, props in self._select(self._table(q['table']), q['filters'])]
+
+        order = q.get('order')
+        if order:
+            by = order['by']
+            key = (lambda r: r[0]) if by in (ID, Entity.ID) else (lambda r: r[1].get(by))
+            rows.sort(key=key, reverse=not order['asc'])
+
+        total = len(rows)
+        paging = q.get('paging')
+        if paging:
+            rows = rows[paging['offset']:paging['offset'] + paging['limit']]
+
+        properties = q.get('properties')
+        if properties:
+            rows = [(id, {k: v for k, v in props.iteritems() if k in properties}) for id, props in rows]
+
+        return {'entities': [{'id': id, 'properties': props} for id, props in rows], 'total': total}
+
+    def put(self, q):
+
+        now = time.time()
+        ids = []
+        with self._lock:
+            table = self._table(q['table'])
+            for ent in q['entities']:
+                id = ent.get('id')
+                if id in (None, '', NIL):
+                    id = self.newId()
+
+                ttl = ent.get('ttl') or 0
+                table[id] = (dict(ent['properties']), now + ttl / 1e9 if ttl > 0 else None)
+                ids.append(id)
+
+        return {'ids': ids}
+
+    def delete(self, q):
+
+        with self._lock:
+            table = self._table(q['table'])
+            rows = self._select(table, q['filters'])
+            for id, _ in rows:
+                del table[id]
+
+        return {'num': len(rows)}
+
+    def update(self, q):
+
+        now = time.time()
+        with self._lock:
+            table = self._table(q['table'])
+            rows = self._select(table, q['filters'])
+
+            for id, props in rows:
+                expires = table[id][1]
+                for change in q['changes']:
+                    op, prop, value = change['op'], change['property'], change['value']
+
+                    if op == Change.Set:
+                        props[prop] = value
+                    elif op == Change.Increment:
+                        # like the server, we only increment numeric values
+                        current = props.get(prop, 0)
+                        if isinstance(current, (int, long, float)):
+                            props[prop] = current + value
+                    elif op == Change.DelProperty:
+                        props.pop(prop, None)
+                    elif op == Change.Expire:
+                        expires = now + value / 1e9
+                    else:
+                        raise ValueError("Unsupported change %s" % op)
+
+                table[id] = (props, expires)
+
+        return {'num': len(rows)}
+
+
+class InMemoryMeduza(object):
+    """
+    A pure python stand-in for the meduza server, for tests and client benchmarks on machines without the meduza
+    binary. It speaks the server's RESP framing and BSON messages, keeping all tables in memory.
+    Supported are GET (EQ/IN/GT/LT/ALL filters, ordering, paging and properties), PUT (with TTLs), DEL, UPDATE
+    (SET/INCR/PDEL/EXP changes) and PING. Schemas are not enforced.
+
+    Usage is the same as DisposableMeduza:
+    >> mdz = InMemoryMeduza(latency=0.001)
+    >> mdz.start()
+    >> meduza.setup(meduza.customConnector('localhost', mdz.port))
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0):
+        """
+        :param latency: artificial seconds to wait before handling each request
+        :param jitter: an extra random wait of up to jitter seconds per request
+        """
+        self.port = None
+        self.ctlPort = None
+        self.latency = latency
+        self.jitter = jitter
+        self.store = MemoryStore()
+        self.requests = 0
+        self._server = None
+        self._thread = None
+
+    def start(self, connectTimeout=DEFAULT_CONNECT_TIMEOUT):
+
+        self._server = _ThreadingServer(('127.0.0.1', 0), _MemoryRequestHandler)
+        self._server.mdz = self
+        self.port = self._server.server_address[1]
+
+        self._thread = threading.Thread(target=self._server.serve_forever, name='meduza-stand-in')
+        self._thread.daemon = True
+        self._thread.start()
+
+        waitPort("localhost", self.port, connectTimeout)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def installSchema(self, schema):
+        """
+        Schemas are not enforced by the stand-in server, so this is a no-op kept for compatibility with DisposableMeduza
+        """
+        pass
+
+    def handle(self, msgType, body):
+        """
+        Execute a single serialized request
+        :return: the response message type and serialized body
+        """
+
+        # requests are handled by a thread per connection
+        with self.store._lock:
+            self.requests += 1
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.random() * self.jitter)
+
+        if msgType == Message.PING:
+            return Message.PING_RESPONSE, bson.BSON.encode({'error': None, 'time': 0})
+
+        respType, handler = {
+            Message.GET: (Message.GET_RESPONSE, self.store.get),
+            Message.PUT: (Message.PUT_RESPONSE, self.store.put),
+            Message.DELETE: (Message.DELETE_RESPONSE, self.store.delete),
+            Message.UPDATE: (Message.UPDATE_RESPONSE, self.store.update),
+        }[msgType]
+
+        st = time.time()
+        try:
+            ret = handler(bson.BSON(body).decode())
+            error = None
+        except Exception as e:
+            logging.exception("Error handling %s request", msgType)
+            ret = {}
+            error = str(e)
+
+        ret['Response'] = {'error': error, 'time': nanoseconds(time.time() - st)}
+
+        return respType, bson.BSON.encode(ret)
+
+
+class _ThreadingServer(SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _MemoryRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Serve one client connection of an InMemoryMeduza server, handling its requests in order
+    """
+
+    def handle(self):
+
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        while True:
+            try:
+                cmd = self._readCommand()
+            except (socket.error, ValueError):
+                return
+            if cmd is None:
+                return
+
+            msgType, body = cmd
+            try:
+                respType, resp = self.server.mdz.handle(msgType, body)
+            except KeyError:
+                self.wfile.write('-ERR unknown message type %s\r\n' % msgType)
+                continue
+
+            self.wfile.write(packCommand(respType, resp))
+
+    def _readCommand(self):
+        """
+        Read a RESP array of bulk strings
+        :return: a list of strings, or None if the connection was closed
+        """
+
+        line = self.rfile.readline()
+        if not line:
+            return None
+
+        if line[0] != '*':
+            raise ValueError("Invalid command: %r" % line)
+
+        ret = []
+        for _ in xrange(int(line[1:])):
+            header = self.rfile.readline()
+            if not header.startswith('$'):
+                raise ValueError("Invalid bulk string: %r" % header)
+            ret.append(self.rfile.read(int(header[1:]) + 2)[:-2])
+
+        return ret
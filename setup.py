@@ -15,4 +15,5 @@ setup(
     url='https://github.com/EverythingMe/meduza-py',
     packages=find_packages(),
     install_requires=['redis>=2.10', 'pymongo>=2.8','hiredis>=0.1.6', 'pyyaml', 'requests'],
+    extras_require={'async': ['trollius'], 'numpy': ['numpy']},
 )
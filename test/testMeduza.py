@@ -2,7 +2,7 @@ import logging
 import signal
 import time
 
-from meduza.testing import DisposableMeduza
+from meduza.testing import DisposableMeduza, InMemoryMeduza
 
 
 __author__ = 'dvirsky'
@@ -18,6 +18,8 @@ except ImportError:
 import meduza
 from meduza.columns import Text, Timestamp, Set, Int, Map
 from meduza.queries import Ordering, PingQuery, Change
+from meduza.pool import ConnectionPool
+import unittest
 from unittest import TestCase
 
 
@@ -194,6 +196,11 @@ class MeduzaE2ETestCase(TestCase):
         self.assertEqual(u2.groups, None)
         self.assertEqual(u2.fancySuperLongNameWatWat, "")
 
+        # partial objects can't be put back over the full ones
+        self.assertIsInstance(u2, User)
+        with self.assertRaises(meduza.ModelError):
+            meduza.put(u2)
+
 
     def testSelect(self):
 
@@ -292,6 +299,52 @@ class MeduzaE2ETestCase(TestCase):
         self.assertEqual(len(users), 0)
 
 
+    def testSave(self):
+
+        u, = meduza.get(User, self.users[0].id)
+        self.assertFalse(u.isDirty())
+        self.assertEqual(meduza.save(u), 0)
+
+        u.name = "saved"
+        u.score = 7
+        self.assertEqual(u.dirtyColumns(), {'name', 'score'})
+        self.assertEqual(meduza.save(u), 1)
+        self.assertFalse(u.isDirty())
+
+        u2, = meduza.get(User, u.id)
+        self.assertEqual((u2.name, u2.score, u2.email), ("saved", 7, self.users[0].email))
+
+        # partial objects save their changes too
+        p, = meduza.get(User, u.id, properties=('score',))
+        p.score = 8
+        self.assertEqual(meduza.save(p), 1)
+        self.assertEqual(meduza.get(User, u.id)[0].score, 8)
+
+        new = User(name="new user", email="new@domain.com")
+        self.assertEqual(meduza.save(new), 1)
+        self.users.append(new)
+        self.assertEqual(meduza.get(User, new.id)[0].name, "new user")
+        self.assertFalse(new.isDirty())
+
+        # changing a container in place is saved too
+        u.groups = {"a"}
+        meduza.save(u)
+        u.groups.add("b")
+        self.assertEqual(meduza.save(u), 1)
+        self.assertEqual(meduza.get(User, u.id)[0].groups, {"a", "b"})
+
+        # objects given an id by the caller are put by their first save too
+        named = User(id="savedUser", name="named user", email="named@domain.com")
+        self.assertEqual(meduza.save(named), 1)
+        self.users.append(named)
+        self.assertEqual(meduza.get(User, "savedUser")[0].name, "named user")
+
+        # updating a deleted entity saves nothing, so the object keeps its changes
+        named.score = 9
+        meduza.delete(User, User.id == "savedUser")
+        self.assertEqual(meduza.save(named), 0)
+        self.assertEqual(named.dirtyColumns(), {'score'})
+
     def testPing(self):
 
         with meduza.customConnector('localhost', self.mdz.port)() as client:
@@ -301,6 +354,102 @@ class MeduzaE2ETestCase(TestCase):
             self.assertIsNone(ret.error)
 
 
+class InMemoryE2ETestCase(MeduzaE2ETestCase):
+    """
+    Run the end to end tests against the in-process stand-in server
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.mdz = InMemoryMeduza()
+        cls.mdz.start()
+
+        provider = meduza.customConnector('localhost', cls.mdz.port)
+        meduza.setup(provider, provider)
+
+    def testRangeFilters(self):
+        from meduza.queries import Condition, Paging
+
+        users = meduza.select(User, User.name.toFilter(Condition.GT, "user 15"), order=Ordering.desc('name'))
+        self.assertEqual([u.name for u in users], ["user 19", "user 18", "user 17", "user 16"])
+
+        users, total = meduza.select(User, User.name.toFilter(Condition.LT, "user 10"), order=Ordering.asc('name'),
+                                     paging=Paging(2, 3), withTotal=True)
+        self.assertEqual(total, 10)
+        self.assertEqual([u.name for u in users], ["user 02", "user 03", "user 04"])
+
+    def testChunkedPut(self):
+
+        provider = meduza.customConnector('localhost', self.mdz.port)
+        session = meduza.Session(provider, provider, putChunkSize=7, putChunkBytes=2000)
+
+        users = [User(name="chunky %03d" % i, email="chunky%03d@domain.com" % i, fancySuperLongNameWatWat="x" * i * 10)
+                 for i in xrange(50)]
+        ids = session.put(*users)
+        self.assertEqual(ids, [u.id for u in users])
+        self.assertEqual(len(set(ids)), len(users))
+
+        try:
+            loaded = session.get(User, *ids)
+            self.assertEqual([u.name for u in loaded], [u.name for u in users])
+        finally:
+            session.delete(User, User.id.any(*ids))
+
+    def testPutMany(self):
+
+        class Group(meduza.Model):
+            _table = "Groups"
+            _schema = "pytest"
+
+            name = Text("name", required=True)
+
+        objects = [User(name="many 1", email="many1@domain.com"), Group(name="group 1"),
+                   User(name="many 2", email="many2@domain.com"), Group(name="group 2")]
+
+        ids = meduza.putMany(*objects)
+        self.assertEqual(ids, [o.id for o in objects])
+        self.assertTrue(all(ids))
+
+        try:
+            self.assertEqual([u.name for u in meduza.get(User, ids[0], ids[2])], ["many 1", "many 2"])
+            self.assertEqual([g.name for g in meduza.get(Group, ids[1], ids[3])], ["group 1", "group 2"])
+        finally:
+            meduza.delete(User, User.id.any(ids[0], ids[2]))
+            meduza.delete(Group, Group.id.any(ids[1], ids[3]))
+
+        with self.assertRaises(meduza.ModelError):
+            meduza.putMany(User(name="many 3"), object())
+
+    def testSaveContainers(self):
+        from meduza.columns import Binary
+
+        class Doc(meduza.Model):
+            _table = "Docs"
+            _schema = "pytest"
+
+            data = Binary("data")
+            view = Binary("view", zeroCopy=True)
+            tags = Set("tags", type=Text())
+            attrs = Map("attrs", type=Text())
+
+        doc = Doc(data='\0\1', view='\2', tags={"a"}, attrs={"k": "v"})
+        meduza.put(doc)
+
+        try:
+            d, = meduza.get(Doc, doc.id)
+            d.data = '\3\4'
+            d.view = '\5'
+            d.tags = {"b", "c"}
+            d.attrs = {"k": "w", "x": "y"}
+            self.assertEqual(meduza.save(d), 1)
+
+            d, = meduza.get(Doc, doc.id)
+            self.assertEqual((d.data, bytes(d.view)), (bytearray('\3\4'), '\5'))
+            self.assertEqual((d.tags, d.attrs), ({"b", "c"}, {"k": "w", "x": "y"}))
+        finally:
+            meduza.delete(Doc, Doc.id == doc.id)
+
+
 class ModelEncodeDecodeTestCase(TestCase):
     def testEncodeModel(self):
         u = User(name="user", email="user@domain.com",
@@ -313,3 +462,991 @@ class ModelEncodeDecodeTestCase(TestCase):
         self.assertEqual(entity.properties['wat'], u.fancySuperLongNameWatWat)
         u2 = User.decode(entity)
         self.assertEqual(u.__dict__, u2.__dict__)
+
+    def testCompiledCodecs(self):
+        from meduza.queries import Entity
+
+        u = User.decode(Entity('u1', name=u'foo', score=3, unknown='x'))
+        self.assertEqual(u.id, 'u1')
+        self.assertEqual(u.name, 'foo')
+        self.assertEqual(u.score, 3)
+        self.assertFalse(hasattr(u, 'unknown'))
+
+        with self.assertRaises(meduza.errors.ColumnValueError):
+            User(email="foo@bar.com").encode()
+
+    def testProjection(self):
+        from meduza.queries import Entity
+
+        Partial = User.projected(['name', 'score'])
+        self.assertIs(Partial, User.projected(('score', 'name')))
+        self.assertIs(User.projected(None), User)
+
+        u = Partial.decode(Entity('u1', name=u'foo', score=3, wat=u'wat'))
+        self.assertEqual(u.__dict__, {'id': 'u1', 'name': 'foo', 'score': 3})
+        self.assertEqual(u.fancySuperLongNameWatWat, "")
+        self.assertEqual(u.tableName(), User.tableName())
+
+        with self.assertRaises(meduza.ModelError):
+            u.encode()
+
+        import pickle
+        for protocol in (0, 2):
+            p = pickle.loads(pickle.dumps(u, protocol))
+            self.assertIs(p.__class__, Partial)
+            self.assertEqual(p.__dict__, u.__dict__)
+
+    def testCompactModel(self):
+        from meduza.queries import Entity
+
+        class CompactUser(meduza.Model):
+            _table = "Users"
+            _schema = "pytest"
+            __compact__ = True
+
+            name = Text("name", required=True)
+            email = Text("email", default='')
+            groups = Set("groups", type=Text())
+            fancySuperLongNameWatWat = Text("wat")
+            mapr = Map("mapr", type=Text())
+            score = Int("score", default=0)
+
+        class CompactAdmin(CompactUser):
+            level = Int("level", default=1)
+
+        u = CompactUser(name="user", email="user@domain.com", groups={"g1", "g2"}, mapr={"foo": "bar"})
+        self.assertFalse(hasattr(u, '__dict__'))
+        self.assertEqual(u.score, 0)
+        self.assertIsNone(u.id)
+        self.assertEqual(u.fancySuperLongNameWatWat, "")
+        self.assertIsInstance(CompactUser.name, Text)
+
+        u2 = CompactUser.decode(u.encode())
+        self.assertEqual(u2._attributes(), u._attributes())
+        self.assertFalse(u2.isDirty())
+        u2.score = 5
+        self.assertEqual(u2.dirtyColumns(), {'score'})
+        self.assertEqual(u2.groups, {"g1", "g2"})
+        with self.assertRaises(AttributeError):
+            u2.unknown = 1
+
+        a = CompactAdmin.decode(Entity('a1', name=u'admin'))
+        self.assertFalse(hasattr(a, '__dict__'))
+        self.assertEqual((a.id, a.name, a.level), ('a1', 'admin', 0))
+        self.assertEqual(CompactAdmin(name="admin").level, 1)
+
+        with self.assertRaises(meduza.ModelError):
+            class BadUser(User):
+                __compact__ = True
+
+        p = CompactUser.projected(['name']).decode(Entity('u1', name=u'foo', score=3))
+        self.assertFalse(hasattr(p, '__dict__'))
+        self.assertEqual((p.name, p.score), ('foo', 0))
+
+    def testCodecsUseLocals(self):
+        import dis
+        from StringIO import StringIO
+
+        Partial = User.projected(['name'])
+        for codec in (User.__decoder__, User.__encoder__, User.__batchDecoder__, User.__batchEncoder__,
+                      Partial.__decoder__, Partial.__batchDecoder__):
+            out, sys.stdout = sys.stdout, StringIO()
+            try:
+                dis.dis(codec)
+            finally:
+                out, sys.stdout = sys.stdout.getvalue(), out
+            self.assertNotIn('LOAD_GLOBAL', out, codec.__name__)
+
+    def testBatchCodecs(self):
+        import datetime
+        from meduza.columns import Key, Float, Bool, Binary, List
+        from meduza.queries import Entity
+
+        now = datetime.datetime(2015, 1, 1)
+        columns = [
+            (Key('id'), [u'a', 'b', 3, None, u'{NIL}']),
+            (Text('text'), [u'a', 'b', u'\u05d0', None, '{NIL}']),
+            (Int('int'), [1, 2L, 3.5, None]),
+            (Float('float'), [1, 2.5, None]),
+            (Bool('bool'), [True, 0, "true", None]),
+            (Timestamp('time'), [now, 1420070400, None]),
+            (Set('set', type=Text()), [[Set.IDENT, u'a', u'b'], [], None]),
+            (List('list', type=Int()), [[List.IDENT, 1, 2], None]),
+            (Map('map', type=Text()), [{u'k': u'v'}, None]),
+            (Binary('binary'), ['\0\1', None]),
+        ]
+        for col, values in columns:
+            decoded = [col.decode(v) for v in values]
+            self.assertEqual(col.decodeMany(values), decoded, type(col))
+            self.assertEqual(col.encodeMany(decoded), [col.encode(v) for v in decoded], type(col))
+
+        rows = [{'id': u'u%d' % i, 'properties': {'name': u'user %d' % i, 'score': i}} for i in xrange(3)]
+        del rows[1]['properties']['score']
+        users = User.__batchDecoder__(rows)
+        self.assertEqual([u.__dict__ for u in users], [User.decode(Entity(r['id'], **r['properties'])).__dict__
+                                                        for r in rows])
+        self.assertNotIn('score', users[1].__dict__)
+
+        entities = User.__batchEncoder__(users)
+        self.assertEqual([(e.id, e.properties) for e in entities], [(e.id, e.properties)
+                                                                    for e in map(User.encode, users)])
+        with self.assertRaises(meduza.errors.ColumnValueError):
+            User.__batchEncoder__([User(name="foo"), User(email="foo@bar.com")])
+
+    def testZeroCopy(self):
+        import bson
+        from meduza.columns import Binary
+
+        payload = bson.BSON.encode({'b': bson.Binary('\0' * 1024), 't': u'\u05d0'}).decode()
+
+        col = Binary('b', zeroCopy=True)
+        b = col.decode(payload['b'])
+        self.assertIs(b, payload['b'])
+        self.assertIs(col.encode(b), b)
+        self.assertEqual(col.decodeMany([b, None]), [b, None])
+
+        view = col.decode(bytearray('\1\2'))
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(col.encode(view), bson.Binary('\1\2'))
+        self.assertEqual(col.encodeMany([view, None]), [bson.Binary('\1\2'), None])
+
+        self.assertEqual(Binary('b').decode(payload['b']), bytearray(1024))
+
+        col = Text('t', zeroCopy=True)
+        self.assertIs(col.decode(payload['t']), payload['t'])
+        self.assertIs(col.encode(payload['t']), payload['t'])
+        self.assertEqual(col.decodeMany([payload['t'], u'{NIL}', None]), [payload['t'], None, None])
+
+        s = 'foo'
+        self.assertIs(Text('t').decode(s), s)
+        self.assertEqual(Text('t').decode(payload['t']), '\xd7\x90')
+
+    def testDirtyTracking(self):
+        import pickle
+        from meduza.queries import Entity
+
+        u = User(name="foo")
+        self.assertEqual(u.dirtyColumns(), {'name', 'email', 'registrationTime', 'score'})
+        u.markClean()
+        self.assertFalse(u.isDirty())
+
+        u.id = "u1"
+        u.notAColumn = 1
+        self.assertFalse(u.isDirty())
+
+        u.score = 3
+        self.assertEqual([(c.property, c.op, c.value) for c in u.changes()], [('score', Change.Set, 3)])
+
+        for protocol in (0, 2):
+            u2 = pickle.loads(pickle.dumps(u, protocol))
+            self.assertEqual(u2.__dict__, u.__dict__)
+            self.assertEqual(u2.dirtyColumns(), {'score'})
+            self.assertFalse(u2.isSaved())
+
+        # objects pickled before changes were tracked have their __dict__ as their state
+        legacy = object.__new__(User)
+        legacy.__setstate__({'id': 'u1', 'name': u'foo'})
+        self.assertEqual((legacy.id, legacy.dirtyColumns()), ('u1', {'name'}))
+        self.assertTrue(legacy.isSaved())
+
+        d = User.decode(Entity('u1', name=u'foo', wat=u'wat'))
+        self.assertEqual(d.changes(), [])
+        self.assertTrue(d.isSaved())
+        d.fancySuperLongNameWatWat = u"\u05d0"
+        self.assertEqual([(c.property, c.value) for c in d.changes()], [('wat', '\xd7\x90')])
+
+        d.markDirty('groups')
+        self.assertEqual(d.dirtyColumns(), {'fancySuperLongNameWatWat', 'groups'})
+        with self.assertRaises(meduza.ModelError):
+            d.markDirty('id')
+
+        # containers changed in place are found by comparing them to their values when loaded or saved
+        c = User.decode(Entity('u2', name=u'foo', groups=[Set.IDENT, u'a'], mapr={u'k': u'v'}))
+        c2, = User.__batchDecoder__([{'id': 'u2', 'properties': {'name': u'foo', 'groups': [Set.IDENT, u'a']}}])
+        for obj in (c, c2):
+            self.assertFalse(obj.isDirty())
+            obj.groups.add('b')
+            self.assertEqual([(ch.property, sorted(ch.value)) for ch in obj.changes()],
+                             [('groups', sorted([Set.IDENT, 'a', 'b']))])
+            obj.markClean()
+            self.assertFalse(obj.isDirty())
+
+        c.mapr['k'] = 'w'
+        self.assertEqual(pickle.loads(pickle.dumps(c, 2)).dirtyColumns(), {'mapr'})
+
+        class Untracked(User):
+            __tracking__ = False
+
+        t = Untracked.decode(Entity('u1', name=u'foo'))
+        t.name = u'bar'
+        self.assertFalse(t.isDirty())
+
+    def testColumnDefaults(self):
+
+        u = User(name="foo")
+        self.assertEqual(u.fancySuperLongNameWatWat, "")
+        self.assertIsNone(u.groups)
+        self.assertIsInstance(User.fancySuperLongNameWatWat, Text)
+
+        u.fancySuperLongNameWatWat = "wat"
+        self.assertEqual(u.fancySuperLongNameWatWat, "wat")
+
+    def testLoadResponse(self):
+        from meduza.queries import GetResponse
+
+        res = GetResponse(Response={}, entities=[{'id': 'u%d' % i, 'properties': {'name': u'user %d' % i}}
+                                                 for i in xrange(3)], total=3)
+        self.assertEqual(res.entities[1].properties['name'], u'user 1')
+
+        users = res.load(User)
+        self.assertEqual([u.id for u in users], ['u0', 'u1', 'u2'])
+        self.assertEqual(users[2].name, 'user 2')
+
+        with self.assertRaises(meduza.MeduzaError):
+            res.load(User)
+
+    def testLazyResult(self):
+        from meduza.queries import GetResponse
+
+        res = GetResponse(Response={}, entities=[{'id': 'u%d' % i, 'properties': {'name': u'user %d' % i}}
+                                                 for i in xrange(5)], total=10)
+        users = res.loadLazy(User)
+
+        self.assertEqual(len(users), 5)
+        self.assertEqual(users.total, 10)
+        self.assertEqual(users[3].name, 'user 3')
+        self.assertIs(users[3], users[3])
+        self.assertEqual([u.id for u in users[1:3]], ['u1', 'u2'])
+        self.assertEqual([u.id for u in users], ['u0', 'u1', 'u2', 'u3', 'u4'])
+
+
+class ColumnarTestCase(TestCase):
+
+    def rows(self):
+        import datetime
+
+        return [{'id': 'u%d' % i, 'properties': {'name': u'user %d' % i, 'score': i * 10,
+                                                   'registrationTime': datetime.datetime(2015, 1, 1, 0, 0, i)}}
+                for i in xrange(3)] + [{'id': 'u3', 'properties': {'groups': ['__MDZS__', 'g1']}}]
+
+    def testNumpy(self):
+        from meduza.queries import GetResponse
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("numpy is not installed")
+
+        res = GetResponse(Response={}, entities=self.rows(), total=4)
+        cols = res.loadColumns(User)
+
+        self.assertEqual(cols['id'], ['u0', 'u1', 'u2', 'u3'])
+        self.assertEqual(cols['name'], ['user 0', 'user 1', 'user 2', None])
+        self.assertEqual(cols['score'].dtype, numpy.int64)
+        self.assertEqual(list(cols['score']), [0, 10, 20, 0])
+        self.assertEqual(cols['registrationTime'][2], numpy.datetime64('2015-01-01T00:00:02'))
+        self.assertTrue(numpy.isnat(cols['registrationTime'][3]))
+        self.assertEqual(cols['groups'], [None, None, None, {'g1'}])
+
+        cols = GetResponse(Response={}, entities=self.rows()).loadColumns(User, properties=['score'])
+        self.assertEqual(sorted(cols), ['id', 'score'])
+
+    def testNumpyImportedOnUse(self):
+        import subprocess
+
+        out = subprocess.check_output([sys.executable, '-c', 'import sys, meduza; print "numpy" in sys.modules'],
+                                      env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+        self.assertEqual(out.strip(), 'False')
+
+    def testArrayFallback(self):
+        import array
+        import math
+        from meduza import columnar
+        from meduza.queries import GetResponse
+
+        numpy, columnar.numpy = columnar.numpy, None
+        try:
+            cols = GetResponse(Response={}, entities=self.rows()).loadColumns(User)
+        finally:
+            columnar.numpy = numpy
+
+        self.assertIsInstance(cols['score'], array.array)
+        self.assertEqual(list(cols['score']), [0, 10, 20, 0])
+        self.assertEqual(cols['registrationTime'][1], 1420070401.0)
+        self.assertTrue(math.isnan(cols['registrationTime'][3]))
+
+    def testColumnarScan(self):
+        from contextlib import contextmanager
+
+        client = ScanTestCase.Client(['u%03d' % i for i in xrange(25)])
+
+        @contextmanager
+        def connector():
+            yield client
+
+        pages = list(meduza.Session(connector, connector).scan(User, pageSize=10, columnar=True))
+        self.assertEqual([len(p['id']) for p in pages], [10, 10, 5])
+        self.assertEqual(list(pages[2]['score']), [0] * 5)
+
+
+class ConnectionPoolTestCase(TestCase):
+
+    class Conn(object):
+        def __init__(self):
+            self.closed = False
+
+        def close(self):
+            self.closed = True
+
+    def testReuse(self):
+        pool = ConnectionPool(self.Conn, maxSize=2)
+
+        with pool.connection() as c1:
+            pass
+        with pool.connection() as c2:
+            self.assertIs(c1, c2)
+
+        st = pool.stats()
+        self.assertEqual(st['created'], 1)
+        self.assertEqual(st['acquired'], 2)
+        self.assertEqual(st['idle'], 1)
+        self.assertEqual(st['inUse'], 0)
+
+    def testDiscardOnError(self):
+        pool = ConnectionPool(self.Conn, maxSize=2)
+
+        with self.assertRaises(ValueError):
+            with pool.connection() as c:
+                raise ValueError()
+
+        self.assertTrue(c.closed)
+        self.assertEqual(pool.stats()['size'], 0)
+
+    def testSaturation(self):
+        pool = ConnectionPool(self.Conn, maxSize=1, waitTimeout=0.05)
+
+        c = pool.acquire()
+        self.assertEqual(pool.stats()['saturation'], 1.0)
+        with self.assertRaises(meduza.PoolExhaustedError):
+            pool.acquire()
+
+        st = pool.stats()
+        self.assertEqual(st['timeouts'], 1)
+        self.assertGreater(st['waitTime'], 0)
+
+        pool.release(c)
+        self.assertIs(pool.acquire(), c)
+
+    def testIdleTimeout(self):
+        pool = ConnectionPool(self.Conn, maxSize=2, idleTimeout=0.01)
+
+        c = pool.acquire()
+        pool.release(c)
+        time.sleep(0.02)
+
+        self.assertIsNot(pool.acquire(), c)
+        self.assertTrue(c.closed)
+
+    def testProcessPools(self):
+        from meduza.client import getPool, poolStats
+
+        # an unused port, as pools connect lazily
+        shared = getPool('localhost', 1, 0.5, maxSize=3)
+        self.assertIs(getPool('localhost', 1, 0.5, maxSize=3), shared)
+
+        other = getPool('localhost', 1, 0.5, maxSize=5)
+        self.assertIsNot(other, shared)
+
+        st = poolStats()['localhost:1']
+        self.assertEqual(sorted((s['maxSize'], s['timeout']) for s in st), [(3, 0.5), (5, 0.5)])
+
+
+class PipelineTestCase(TestCase):
+
+    class Client(object):
+        def __init__(self, responses):
+            self.responses = responses
+            self.sent = []
+
+        def doMany(self, queries):
+            self.sent.append(queries)
+            return self.responses[:len(queries)]
+
+    def testExecute(self):
+        from contextlib import contextmanager
+        from meduza.queries import GetResponse, PutResponse, UpdateResponse
+
+        client = self.Client([
+            GetResponse(Response={}, entities=[{'id': 'u1', 'properties': {'name': 'foo'}}], total=1),
+            PutResponse(Response={}, ids=['u2']),
+            UpdateResponse(Response={'error': 'oops'}),
+        ])
+
+        @contextmanager
+        def connector():
+            yield client
+
+        p = meduza.Session(connector, connector).pipeline()
+        u = User(name="bar")
+        p.get(User, 'u1').put(u).update(User, User.name == "bar", name="baz")
+        self.assertEqual(len(p), 3)
+
+        users, ids, err = p.execute()
+        self.assertEqual(len(client.sent), 1)
+        self.assertEqual(len(client.sent[0]), 3)
+        self.assertEqual(users[0].name, 'foo')
+        self.assertEqual(ids, ['u2'])
+        self.assertEqual(u.id, 'u2')
+        self.assertIsInstance(err, meduza.RequestError)
+        self.assertEqual(len(p), 0)
+
+    def testRawWritesGoToMaster(self):
+        from contextlib import contextmanager
+        from meduza.queries import PutQuery, PutResponse, GetQuery, GetResponse
+
+        master = self.Client([PutResponse(Response={}, ids=['u1'])])
+        slave = self.Client([GetResponse(Response={}, entities=[], total=0)])
+
+        def connector(client):
+            @contextmanager
+            def connect():
+                yield client
+            return connect
+
+        session = meduza.Session(connector(master), connector(slave))
+
+        p = session.pipeline().add(PutQuery(User.tableName(), User(name="raw").encode()))
+        res, = p.execute()
+        self.assertEqual(res.ids, ['u1'])
+        self.assertEqual((len(master.sent), len(slave.sent)), (1, 0))
+
+        session.pipeline().add(GetQuery(User.tableName())).execute()
+        self.assertEqual((len(master.sent), len(slave.sent)), (1, 1))
+
+
+try:
+    import trollius
+except ImportError:
+    trollius = None
+
+
+@unittest.skipIf(trollius is None, "trollius is not installed")
+class AsyncClientTestCase(TestCase):
+
+    def testPipelinedPing(self):
+        import bson
+        from trollius import From, Return
+        from meduza.aio import AsyncRedisClient, readReply, packCommand
+
+        loop = trollius.new_event_loop()
+
+        @trollius.coroutine
+        def handle(reader, writer):
+            body = bson.BSON.encode({'error': None, 'time': 1})
+            while True:
+                try:
+                    cmd = yield From(readReply(reader))
+                except meduza.MeduzaError:
+                    break
+                self.assertEqual(cmd[0], 'PING')
+                writer.write(packCommand('PONG', body))
+
+        server = loop.run_until_complete(trollius.start_server(handle, '127.0.0.1', 0, loop=loop))
+        port = server.sockets[0].getsockname()[1]
+
+        client = AsyncRedisClient('127.0.0.1', port, timeout=1, poolSize=2, loop=loop)
+
+        @trollius.coroutine
+        def run():
+            res = yield From(trollius.gather(*[client.do(PingQuery()) for _ in xrange(20)], loop=loop))
+            many = yield From(client.doMany([PingQuery(), PingQuery()]))
+            raise Return(res + many)
+
+        try:
+            res = loop.run_until_complete(run())
+        finally:
+            client.close()
+            server.close()
+            loop.close()
+
+        self.assertEqual(len(res), 22)
+        for r in res:
+            self.assertIsNone(r.error)
+
+
+@unittest.skipIf(trollius is None, "trollius is not installed")
+class AsyncSessionTestCase(TestCase):
+
+    def testRoundTrip(self):
+        from trollius import From, Return
+        from meduza.aio import AsyncRedisClient, AsyncSession
+
+        mdz = InMemoryMeduza()
+        mdz.start()
+        self.addCleanup(mdz.stop)
+
+        loop = trollius.new_event_loop()
+        client = AsyncRedisClient('localhost', mdz.port, timeout=2, loop=loop)
+        session = AsyncSession(client)
+
+        @trollius.coroutine
+        def run():
+            users = [User(name="async %d" % i, email="async%d@domain.com" % i) for i in xrange(3)]
+            ids = yield From(session.put(*users))
+            many = yield From(session.putMany(User(name="async 3")))
+
+            num = yield From(session.update(User, User.id.any(*ids), score=5))
+            selected = yield From(session.select(User, User.id.any(*ids), order=Ordering.asc('name')))
+            got = yield From(session.get(User, many[0]))
+
+            got[0].score = 6
+            saved = yield From(session.save(got[0]))
+            new = User(id="asyncSaved", name="async saved")
+            saved += yield From(session.save(new))
+            got = yield From(session.get(User, many[0], new.id))
+            raise Return(ids, num, selected, saved, got)
+
+        try:
+            ids, num, selected, saved, got = loop.run_until_complete(run())
+        finally:
+            client.close()
+            loop.close()
+
+        self.assertEqual(num, 3)
+        self.assertEqual([u.id for u in selected], ids)
+        self.assertEqual([(u.name, u.score) for u in selected], [("async %d" % i, 5) for i in xrange(3)])
+        self.assertEqual(saved, 2)
+        self.assertEqual([(u.name, u.score) for u in got], [("async 3", 6), ("async saved", 0)])
+
+        # the blocking Session methods aren't there to be called by mistake
+        self.assertFalse(isinstance(session, meduza.Session))
+        self.assertFalse(hasattr(session, 'scan'))
+
+
+class ReplicaConnectorTestCase(TestCase):
+
+    def setUp(self):
+        self.servers = [InMemoryMeduza(), InMemoryMeduza()]
+        for mdz in self.servers:
+            mdz.start()
+
+    def tearDown(self):
+        for mdz in self.servers:
+            mdz.stop()
+
+    def ping(self, connector, n):
+        for _ in xrange(n):
+            with connector() as client:
+                self.assertTrue(meduza.ping(client))
+
+    def testRouting(self):
+        from meduza.replicas import ROUND_ROBIN, LEAST_OUTSTANDING, EWMA
+
+        endpoints = [('localhost', mdz.port) for mdz in self.servers]
+        for policy in (ROUND_ROBIN, LEAST_OUTSTANDING, EWMA):
+            connector = meduza.ReplicaConnector(endpoints, policy=policy, healthCheckInterval=None)
+            self.ping(connector, 10)
+
+            requests = [r.requests for r in connector.replicas]
+            self.assertEqual(sum(requests), 10)
+            if policy == ROUND_ROBIN:
+                self.assertEqual(requests, [5, 5])
+            else:
+                self.assertTrue(all(requests))
+                self.assertTrue(all(r.latency is not None for r in connector.replicas))
+
+    def testHealthChecks(self):
+
+        dead = InMemoryMeduza()
+        dead.start()
+        dead.stop()
+
+        connector = meduza.ReplicaConnector([('localhost', self.servers[0].port), ('localhost', dead.port)],
+                                            healthCheckInterval=None)
+        live, down = connector.replicas
+
+        connector.checkHealth()
+        self.assertTrue(live.healthy)
+        self.assertFalse(down.healthy)
+
+        self.ping(connector, 4)
+        self.assertEqual(live.requests, 4)
+        self.assertEqual(down.requests, 0)
+
+        # a replica that recovers is returned to rotation by the next check
+        live.healthy = False
+        connector.checkHealth()
+        self.assertTrue(live.healthy)
+
+        # a replica whose pool is saturated by requests is still healthy
+        live.pool.waitTimeout = 0.01
+        transports = [live.pool.acquire() for _ in xrange(live.pool.maxSize)]
+        try:
+            with self.assertRaises(meduza.PoolExhaustedError):
+                with live.pool.connection():
+                    pass
+            connector.checkHealth()
+            self.assertTrue(live.healthy)
+        finally:
+            for transport in transports:
+                live.pool.release(transport)
+            connector.close()
+
+
+class SharedClientTestCase(TestCase):
+
+    def testConcurrentCallers(self):
+        import threading
+        from meduza.queries import GetQuery, PutQuery
+
+        mdz = InMemoryMeduza(jitter=0.0005)
+        mdz.start()
+        self.addCleanup(mdz.stop)
+
+        client = meduza.RedisClient('localhost', mdz.port, timeout=2)
+        errors = []
+
+        def worker(n):
+            try:
+                for i in xrange(20):
+                    name = "worker %d-%d" % (n, i)
+                    id, = client.do(PutQuery("Users", User(name=name).encode())).ids
+
+                    res = client.do(GetQuery("Users").filter('id', 'IN', id))
+                    self.assertEqual(res.entities[0].properties['name'], name)
+
+                    # manual pipelining keeps this thread's queries on one connection
+                    client.send(GetQuery("Users").filter('id', 'IN', id))
+                    client.send(PingQuery())
+                    self.assertEqual(client.receive().entities[0].properties['name'], name)
+                    self.assertIsNone(client.receive().error)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in xrange(16)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(mdz.store._table("Users")), 16 * 20)
+
+
+class ForkAndWarmupTestCase(TestCase):
+
+    def setUp(self):
+        self.mdz = InMemoryMeduza()
+        self.mdz.start()
+
+    def tearDown(self):
+        self.mdz.stop()
+
+    def testWarmup(self):
+        from contextlib import contextmanager
+
+        connector = meduza.customConnector('localhost', self.mdz.port)
+        meduza.warmup(connector, 3)
+        self.assertEqual(connector.pool.stats()['idle'], 3)
+        self.assertEqual(self.mdz.requests, 3)
+
+        # connectors without a warmup method are warmed by nested checkouts
+        pool = ConnectionPool(lambda: meduza.RedisTransport('localhost', self.mdz.port))
+
+        @contextmanager
+        def plain():
+            with pool.connection() as transport:
+                yield meduza.RedisClient(transport=transport)
+
+        meduza.warmup(plain, 4)
+        self.assertEqual(pool.stats()['idle'], 4)
+        self.assertEqual(pool.stats()['created'], 4)
+
+        # a warmup running out of connections keeps the ones it already opened
+        from meduza.client import warmPool
+        pool = ConnectionPool(lambda: meduza.RedisTransport('localhost', self.mdz.port), maxSize=3, waitTimeout=0.01)
+        held = pool.acquire()
+        with self.assertRaises(meduza.PoolExhaustedError):
+            warmPool(pool, 3)
+        pool.release(held)
+        st = pool.stats()
+        self.assertEqual((st['idle'], st['closed']), (3, 0))
+
+    def testFork(self):
+
+        connector = meduza.customConnector('localhost', self.mdz.port)
+        with connector() as client:
+            self.assertTrue(meduza.ping(client))
+
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # the child must not reuse the connection it inherited
+            try:
+                ok = True
+                for _ in xrange(10):
+                    with connector() as client:
+                        ok = ok and meduza.ping(client)
+                ok = ok and connector.pool.stats()['created'] == 2
+                os.write(w, 'ok' if ok else 'fail')
+            finally:
+                os._exit(0)
+
+        os.close(w)
+        os.waitpid(pid, 0)
+        self.assertEqual(os.read(r, 10), 'ok')
+        os.close(r)
+
+        # and the parent's connection survives the child
+        for _ in xrange(10):
+            with connector() as client:
+                self.assertTrue(meduza.ping(client))
+        self.assertEqual(connector.pool.stats()['created'], 1)
+
+
+class ScanTestCase(TestCase):
+
+    class Client(object):
+        def __init__(self, rows):
+            self.rows = rows
+            self.offsets = []
+
+        def do(self, q):
+            from meduza.queries import GetResponse
+
+            self.offsets.append(q.paging.offset)
+            page = self.rows[q.paging.offset:q.paging.offset + q.paging.limit]
+            return GetResponse(Response={}, entities=[{'id': id, 'properties': {}} for id in page],
+                               total=len(self.rows))
+
+    def session(self, client):
+        from contextlib import contextmanager
+
+        @contextmanager
+        def connector():
+            yield client
+
+        return meduza.Session(connector, connector)
+
+    def testScan(self):
+        ids = ['u%03d' % i for i in xrange(25)]
+
+        for prefetch in (0, 1, 3):
+            client = self.Client(ids)
+            users = list(self.session(client).scan(User, pageSize=10, prefetch=prefetch))
+            self.assertEqual([u.id for u in users], ids)
+            self.assertEqual(client.offsets, [0, 10, 20])
+
+    def testEarlyExit(self):
+        client = self.Client(['u%03d' % i for i in xrange(100)])
+
+        it = self.session(client).scan(User, pageSize=10, prefetch=2)
+        self.assertEqual(next(it).id, 'u000')
+        it.close()
+        time.sleep(0.3)
+
+        # the prefetcher stops after filling the queue
+        self.assertLessEqual(len(client.offsets), 4)
+
+
+class SerializerTestCase(TestCase):
+
+    def testSameAsDictify(self):
+        from meduza import queries
+        from meduza.client import dictify, _serializers
+
+        u = User(name="foo", email="foo@bar.com", groups={"a", "b"}, mapr={"x": "y"})
+        u.id = "u1"
+
+        qs = [
+            queries.GetQuery(User.tableName(), properties=('name',), filters=(User.name == "foo",),
+                             order=Ordering.desc('name'), paging=queries.Paging(10, 20)),
+            queries.GetQuery(User.tableName()).filter('id', queries.Condition.IN, 'a', 'b'),
+            queries.PutQuery(User.tableName(), u.encode()),
+            queries.DelQuery(User.tableName(), User.id.any('a', 'b')),
+            queries.UpdateQuery(User.tableName(), (User.name == "foo",), Change.set("name", "bar"),
+                                User.score + 2, Change.expire(10)),
+            PingQuery(),
+        ]
+
+        for q in qs:
+            self.assertEqual(_serializers[type(q)](q), dictify(q))
+
+
+class CacheTestCase(TestCase):
+
+    def testLRU(self):
+        from meduza.cache import LRUCache
+
+        c = LRUCache(maxSize=2, ttl=0.05)
+        c.set('a', 1)
+        c.set('b', 2)
+        self.assertEqual(c.get('a'), 1)
+        c.set('c', 3)
+        self.assertIsNone(c.get('b'))
+        self.assertEqual(c.get('c'), 3)
+
+        time.sleep(0.06)
+        self.assertIsNone(c.get('a'))
+
+        st = c.stats()
+        self.assertEqual((st['hits'], st['misses'], st['evictions'], st['expirations']), (2, 2, 1, 1))
+
+    def testReadThrough(self):
+        from contextlib import contextmanager
+        from meduza.queries import GetResponse, UpdateResponse
+
+        class Client(object):
+            queried = []
+
+            def do(self, q):
+                if isinstance(q, meduza.queries.UpdateQuery):
+                    return UpdateResponse(Response={}, num=1)
+
+                ids = q.filters['id'].values
+                self.queried.append(ids)
+                return GetResponse(Response={}, entities=[{'id': id, 'properties': {'name': u'user'}}
+                                                          for id in ids])
+
+        @contextmanager
+        def connector():
+            yield Client()
+
+        cache = meduza.LRUCache()
+        session = meduza.Session(connector, connector, cache=cache)
+
+        users = session.get(User, 'a', 'b')
+        users[0].name = 'changed'
+        users = session.get(User, 'b', 'c', 'a')
+
+        self.assertEqual([u.id for u in users], ['b', 'c', 'a'])
+        self.assertEqual(users[2].name, 'user')
+        self.assertEqual(Client.queried, [('a', 'b'), ('c',)])
+
+        # writes by id only invalidate these ids
+        session.update(User, User.id == 'a', name='foo')
+        session.get(User, 'a', 'b')
+        self.assertEqual(Client.queried[-1], ('a',))
+        self.assertEqual(cache.stats()['hits'], 3)
+
+        session.update(User, User.name == 'user', name='foo')
+        self.assertEqual(len(cache), 0)
+
+        # duplicate ids get one object, like without the cache
+        self.assertEqual([u.id for u in session.get(User, 'a', 'a', 'b')], ['a', 'b'])
+
+
+class CoalesceTestCase(TestCase):
+
+    def testConcurrentGets(self):
+        import threading
+        from contextlib import contextmanager
+        from meduza.queries import GetResponse
+
+        class Client(object):
+            queried = []
+            release = threading.Event()
+
+            def do(self, q):
+                ids = q.filters['id'].values
+                self.queried.append(ids)
+                self.release.wait()
+                return GetResponse(Response={}, entities=[{'id': id, 'properties': {'name': u'user %s' % id}}
+                                                          for id in ids if id != 'missing'])
+
+        @contextmanager
+        def connector():
+            yield Client()
+
+        session = meduza.Session(connector, connector, coalesce=True)
+        results = {}
+        # don't leave the workers blocked if we fail
+        self.addCleanup(Client.release.set)
+
+        def worker(n, ids):
+            results[n] = session.get(User, *ids)
+
+        def waitFor(stat, value):
+            deadline = time.time() + 5
+            while session.coalescer.stats()[stat] < value:
+                if time.time() > deadline:
+                    self.fail("Timed out waiting for %s to reach %d: %s" % (stat, value, session.coalescer.stats()))
+                time.sleep(0.001)
+
+        threads = [threading.Thread(target=worker, args=(0, ('a', 'b')))]
+        threads += [threading.Thread(target=worker, args=(n, ('b', 'a', 'missing'))) for n in xrange(1, 5)]
+        for t in threads:
+            t.daemon = True
+
+        threads[0].start()
+        waitFor('inFlight', 1)
+
+        for t in threads[1:]:
+            t.start()
+        waitFor('joined', 4 * 2 + 3)
+
+        Client.release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(sorted(Client.queried), [('a', 'b'), ('missing',)])
+        self.assertEqual([u.id for u in results[0]], ['a', 'b'])
+        for n in xrange(1, 5):
+            self.assertEqual([u.name for u in results[n]], ['user b', 'user a'])
+            self.assertIsNot(results[n][0], results[0][1])
+        self.assertEqual(session.coalescer.stats()['inFlight'], 0)
+
+
+class BenchTestCase(TestCase):
+
+    def testRunAndCompare(self):
+        from meduza import bench
+
+        res = bench.run(rowCounts=(2,), repeat=1, match='model.decode', out=None)
+        self.assertEqual(sorted(res['results']), ['model.decode[narrow,2]', 'model.decode[wide,2]'])
+        for r in res['results'].values():
+            self.assertGreater(r['opsPerSec'], 0)
+            self.assertEqual(r['rows'], 2)
+
+        slower = json.loads(json.dumps(res))
+        slower['results']['model.decode[wide,2]']['perRow'] *= 2
+        self.assertEqual(bench.compare(res, slower, out=None), ['model.decode[wide,2]'])
+        self.assertLess(res['memory']['compact'], res['memory']['dict'])
+
+
+class StatsTestCase(TestCase):
+
+    def testHistogram(self):
+        from meduza.stats import Histogram
+
+        h = Histogram()
+        for i in xrange(1, 101):
+            h.record(i * 1e-3)
+
+        snap = h.snapshot()
+        self.assertEqual(snap['count'], 100)
+        self.assertAlmostEqual(snap['mean'], 0.0505)
+        self.assertEqual(snap['max'], 0.1)
+        # percentiles are bucket upper bounds, within a factor of 2 of the real value
+        self.assertTrue(0.05 <= snap['p50'] <= 0.1)
+        self.assertEqual(snap['p99'], 0.1)
+
+    def testQueryStats(self):
+        mdz = InMemoryMeduza()
+        mdz.start()
+        try:
+            session = meduza.Session(meduza.customConnector('localhost', mdz.port),
+                                     meduza.customConnector('localhost', mdz.port))
+            meduza.stats.reset()
+
+            ids = session.put(User(name="foo"), User(name="bar"))
+            session.get(User, *ids)
+            session.pipeline().get(User, ids[0]).select(User, User.all()).execute()
+        finally:
+            mdz.stop()
+
+        snap = meduza.stats.snapshot(table=User.tableName())
+        self.assertEqual(set(snap), {'PUT', 'GET'})
+        self.assertEqual(set(snap['PUT'][User.tableName()]), {'serialize', 'network', 'deserialize', 'server'})
+        get = snap['GET'][User.tableName()]
+        self.assertEqual(get['network']['count'], 3)
+        self.assertEqual(get['decode']['count'], 3)